@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+
+def load_app(folder, module_name):
+    """两个程序都是单文件的 app.py，按路径分别加载，避免模块名冲突"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, folder, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def comparator():
+    return load_app('图片比较器', 'comparator_app')
+
+
+@pytest.fixture(scope='session')
+def similarity():
+    return load_app('图片近似器', 'similarity_app')
+
+
+@pytest.fixture(scope='session')
+def qt_app(comparator):
+    """Worker 是 QThread，直接调用 run() 也需要先有 QCoreApplication"""
+    from PyQt6.QtCore import QCoreApplication
+    return QCoreApplication.instance() or QCoreApplication([])
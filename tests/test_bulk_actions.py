@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+
+class SimulatedCrash(BaseException):
+    """绕过 _apply 中按条目捕获的 Exception，模拟进程在操作中途退出"""
+
+
+@pytest.fixture(params=['comparator', 'similarity'])
+def app(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.fixture
+def files(tmp_path):
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    paths = {}
+    for name in ('keeper.png', 'dup_delete.png', 'dup_quarantine.png', 'dup_hardlink.png'):
+        paths[name] = folder / name
+        paths[name].write_bytes(name.encode() * 100)
+    return paths
+
+
+def read(path):
+    return path.read_bytes()
+
+
+def test_execute_then_undo_restores_files(app, tmp_path, files):
+    engine = app.BulkActionEngine(str(tmp_path / 'state'))
+    keeper = str(files['keeper.png'])
+    originals = {name: read(path) for name, path in files.items()}
+    plan = [(app.ACTION_DELETE, str(files['dup_delete.png']), keeper),
+            (app.ACTION_QUARANTINE, str(files['dup_quarantine.png']), keeper),
+            (app.ACTION_HARDLINK, str(files['dup_hardlink.png']), keeper)]
+
+    journal_path, completed, failed = engine.execute(plan)
+    assert failed == []
+    assert len(completed) == 3
+    assert not files['dup_delete.png'].exists()
+    assert not files['dup_quarantine.png'].exists()
+    assert os.path.samefile(files['dup_hardlink.png'], keeper)
+
+    restored, unrecoverable = engine.undo(journal_path)
+    assert sorted(entry['action'] for entry in restored) == [app.ACTION_HARDLINK, app.ACTION_QUARANTINE]
+    assert [entry['action'] for entry in unrecoverable] == [app.ACTION_DELETE]
+    assert read(files['dup_quarantine.png']) == originals['dup_quarantine.png']
+    assert read(files['dup_hardlink.png']) == originals['dup_hardlink.png']
+    assert not os.path.samefile(files['dup_hardlink.png'], keeper)
+    assert read(files['keeper.png']) == originals['keeper.png']
+
+    # 再次撤销不会重复恢复
+    assert engine.undo(journal_path) == ([], [unrecoverable[0]])
+
+
+@pytest.mark.parametrize('action', ['quarantine', 'hardlink'])
+def test_recover_rolls_back_interrupted_action(app, tmp_path, files, monkeypatch, action):
+    state_dir = str(tmp_path / 'state')
+    keeper, target = str(files['keeper.png']), files['dup_quarantine.png']
+    original = read(target)
+    move_file = app.move_file
+
+    def crash_after_move(src, dst):
+        move_file(src, dst)
+        raise SimulatedCrash
+
+    monkeypatch.setattr(app, 'move_file', crash_after_move)
+    with pytest.raises(SimulatedCrash):
+        app.BulkActionEngine(state_dir).execute([(action, str(target), keeper)])
+    monkeypatch.undo()
+    assert not target.exists()  # 原文件已进入隔离区，但日志中只有 begin
+
+    # 重启后回滚未完成的操作
+    engine = app.BulkActionEngine(state_dir)
+    assert engine.recover() == 1
+    assert read(target) == original
+    assert not os.path.exists(f"{target}.simlink-tmp")
+    assert engine.recover() == 0
+
+
+def test_unknown_action_is_rejected_before_touching_files(app, tmp_path, files):
+    engine = app.BulkActionEngine(str(tmp_path / 'state'))
+    plan = [(app.ACTION_DELETE, str(files['dup_delete.png']), None),
+            ('shred', str(files['dup_quarantine.png']), None)]
+    with pytest.raises(ValueError):
+        engine.execute(plan)
+    assert files['dup_delete.png'].exists()
+    assert engine.journals() == []
+
+
+def test_failed_link_replace_puts_original_back(app, tmp_path, files, monkeypatch):
+    engine = app.BulkActionEngine(str(tmp_path / 'state'))
+    keeper, target = str(files['keeper.png']), files['dup_hardlink.png']
+    original = read(target)
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if str(src).endswith('.simlink-tmp'):
+            raise OSError('replace failed')
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    _, completed, failed = engine.execute([(app.ACTION_HARDLINK, str(target), keeper)])
+    monkeypatch.undo()
+    assert completed == []
+    assert len(failed) == 1
+    assert read(target) == original
+    assert not os.path.samefile(target, keeper)
+    assert not os.path.exists(f"{target}.simlink-tmp")
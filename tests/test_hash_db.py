@@ -0,0 +1,74 @@
+import itertools
+
+import numpy
+import pytest
+from PIL import Image, ImageFilter
+
+
+def textured(seed, size=(160, 120)):
+    rng = numpy.random.default_rng(seed)
+    pixels = (rng.random((size[1] // 8, size[0] // 8, 3)) * 255).astype('uint8')
+    return Image.fromarray(pixels).resize(size, Image.BICUBIC)
+
+
+@pytest.fixture(scope='module')
+def image_folder(tmp_path_factory):
+    """几组近似图片（重新压缩、模糊、缩小、镜像）加上互不相似的单张图片"""
+    folder = tmp_path_factory.mktemp('images')
+    for seed in range(4):
+        image = textured(seed)
+        image.save(folder / f'{seed}_original.png')
+        image.save(folder / f'{seed}_q70.jpg', quality=70)
+        image.filter(ImageFilter.GaussianBlur(1)).save(folder / f'{seed}_blur.png')
+        image.resize((80, 60)).save(folder / f'{seed}_small.png')
+        image.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(folder / f'{seed}_flipped.png')
+    for seed in range(10, 16):
+        textured(seed).save(folder / f'single_{seed}.png')
+    return str(folder)
+
+
+def run_worker(comparator, folder, **options):
+    worker = comparator.Worker([folder], 80, 8, **options)
+    groups = []
+    worker.finished.connect(groups.append)
+    worker.run()
+    return worker, groups[0]
+
+
+def normalized(groups):
+    return sorted(sorted(group) for group in groups)
+
+
+@pytest.mark.parametrize('orientations', [False, True])
+@pytest.mark.parametrize('algorithms', [('phash', 'ahash', 'dhash'), ('phash', 'whash', 'colorhash')])
+def test_hash_db_round_trip_matches_in_memory_scan(comparator, qt_app, image_folder, tmp_path, orientations,
+                                                   algorithms):
+    worker, groups = run_worker(comparator, image_folder, orientations=orientations, algorithms=algorithms)
+    assert groups
+
+    db_path = str(tmp_path / 'scan.simdb')
+    comparator.write_hash_db(db_path, worker.hash_size, worker.hashes, worker.variants if orientations else None,
+                             algorithms, worker.quality)
+    db = comparator.HashDatabase(db_path)
+    assert len(db) == len(worker.hashes)
+    assert db.algorithms == algorithms
+
+    # 哈希和画质特征原样读回
+    for i in range(len(db)):
+        path = db.path(i)
+        expected = worker.variants[path] if orientations else worker.variants[path][:1]
+        assert [tuple(map(str, hashes)) for hashes in db.hash_variants(i)] == \
+               [tuple(map(str, hashes)) for hashes in expected]
+        assert db.quality(i) == pytest.approx(worker.quality[path])
+
+    # 向量化比较与逐对比较得到相同的相似对，分组与内存扫描一致
+    max_phash_dist = comparator.get_max_phash_dist(8, 80)
+    expected_pairs = {(a, b) for a, b in itertools.combinations(sorted(worker.variants), 2)
+                      if comparator.matches_any_orientation(worker.variants[a], worker.variants[b], 80,
+                                                            max_phash_dist, algorithms)}
+    db_pairs = {tuple(sorted((db.path(i), db.path(j)))) for i, j in comparator.find_similar_pairs_in_db(db, 80)}
+    assert db_pairs == expected_pairs
+    assert normalized(comparator.group_pairs(db_pairs)) == normalized(groups)
+
+    _, db_groups = run_worker(comparator, image_folder, hash_db_path=db_path)
+    assert normalized(db_groups) == normalized(groups)
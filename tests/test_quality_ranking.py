@@ -0,0 +1,87 @@
+import numpy
+import pytest
+from PIL import Image, ImageFilter
+
+
+def photo_like(seed=1, size=(480, 360)):
+    """平滑渐变的仿照片图像，压缩后块效应比原有细节更明显"""
+    y, x = numpy.mgrid[0:size[1], 0:size[0]]
+    base = numpy.stack([128 + 100 * numpy.sin(x / (30.0 + seed) + c) * numpy.cos(y / (50.0 - seed) - c)
+                        for c in range(3)], axis=-1)
+    return Image.fromarray(numpy.clip(base, 0, 255).astype('uint8')).filter(ImageFilter.GaussianBlur(2))
+
+
+def detailed(seed=1, size=(480, 360)):
+    """带细网格和纹理的高细节图像"""
+    rng = numpy.random.default_rng(seed)
+    pixels = (rng.random((size[1], size[0], 3)) * 255).astype('uint8')
+    pixels = numpy.array(Image.fromarray(pixels).filter(ImageFilter.GaussianBlur(2)))
+    pixels[::24, :, :] = 0
+    pixels[:, ::24, :] = 255
+    return Image.fromarray(pixels)
+
+
+def measure(comparator, paths):
+    quality = {}
+    for path in paths:
+        _, hashes = comparator.calculate_hashes_for_image(str(path), 8, quality=quality)
+        assert hashes[0] is not None
+    return quality
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_lossless_beats_recompressed_copies(comparator, tmp_path, seed):
+    image = photo_like(seed)
+    png, q95, q60 = tmp_path / 'original.png', tmp_path / 'copy_q95.jpg', tmp_path / 'flipped_q60.jpg'
+    image.save(png)
+    image.save(q95, quality=95)
+    image.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(q60, quality=60)
+
+    quality = measure(comparator, [png, q95, q60])
+    assert quality[str(q60)]['sharpness'] > quality[str(png)]['sharpness']  # 块效应抬高了拉普拉斯方差
+    assert comparator.rank_group([str(q60), str(q95), str(png)], quality) == [str(png), str(q95), str(q60)]
+
+
+def test_sharper_original_beats_bloated_resave(comparator, tmp_path):
+    original, resave = tmp_path / 'original.jpg', tmp_path / 'resave.jpg'
+    detailed().save(original, quality=85)
+    Image.open(original).filter(ImageFilter.GaussianBlur(1.2)).save(resave, quality=100)
+
+    quality = measure(comparator, [original, resave])
+    assert quality[str(resave)]['file_size'] > quality[str(original)]['file_size']
+    assert comparator.get_best_image_in_group([str(resave), str(original)], quality) == str(original)
+
+
+def test_downscaled_lossless_copy_does_not_beat_full_size_jpeg(comparator, tmp_path):
+    large, thumbnail = tmp_path / 'large.jpg', tmp_path / 'thumbnail.png'
+    image = detailed(size=(960, 720))
+    image.save(large, quality=92)
+    image.resize((240, 180)).save(thumbnail)
+
+    quality = measure(comparator, [large, thumbnail])
+    assert comparator.get_best_image_in_group([str(thumbnail), str(large)], quality) == str(large)
+
+
+@pytest.mark.parametrize('blur', [0, 1])
+def test_png_resave_of_jpeg_does_not_beat_the_original(comparator, tmp_path, blur):
+    original, resave = tmp_path / 'original.jpg', tmp_path / 'resave.png'
+    detailed().save(original, quality=90)
+    decoded = Image.open(original)
+    (decoded.filter(ImageFilter.GaussianBlur(blur)) if blur else decoded).save(resave)
+
+    quality = measure(comparator, [original, resave])
+    assert quality[str(resave)]['file_size'] > quality[str(original)]['file_size']
+    assert comparator.get_best_image_in_group([str(resave), str(original)], quality) == str(original)
+
+
+def test_unblurred_png_resave_is_recognised_as_jpeg(comparator, tmp_path):
+    original, resave, genuine = tmp_path / 'original.jpg', tmp_path / 'resave.png', tmp_path / 'genuine.png'
+    image = photo_like()
+    image.save(original, quality=85)
+    Image.open(original).save(resave)
+    image.save(genuine)
+
+    quality = measure(comparator, [original, resave, genuine])
+    assert quality[str(resave)]['lossless'] == 0
+    assert quality[str(resave)]['jpeg_quality'] == pytest.approx(quality[str(original)]['jpeg_quality'], abs=5)
+    assert quality[str(genuine)]['lossless'] == 1
@@ -0,0 +1,85 @@
+import os
+import time
+
+import numpy
+import pytest
+from PIL import Image
+
+
+def textured(seed, size=(96, 72)):
+    rng = numpy.random.default_rng(seed)
+    pixels = (rng.random((size[1] // 8, size[0] // 8, 3)) * 255).astype('uint8')
+    return Image.fromarray(pixels).resize(size, Image.BICUBIC)
+
+
+@pytest.fixture
+def client(similarity, tmp_path, monkeypatch):
+    monkeypatch.setattr(similarity, 'action_engine', similarity.BulkActionEngine(str(tmp_path / 'state')))
+    client = similarity.app.test_client()
+    client.get('/')
+    return client
+
+
+def session_state(similarity, client):
+    with client.session_transaction() as flask_session:
+        return similarity.sessions[flask_session['sid']]
+
+
+def run_job(client, state, reference):
+    state.reference_image_path = reference
+    job_id = client.post('/process_images', json={'threshold': 80, 'hash_size': 8}).get_json()['job_id']
+    for _ in range(200):
+        status = client.get(f'/jobs/{job_id}').get_json()['job']['status']
+        if status not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    assert status == 'done'
+    return job_id
+
+
+def test_bulk_action_uses_the_jobs_own_results_and_reference(similarity, client, tmp_path):
+    """同一会话（同一浏览器的两个标签页）中后完成的任务不能改变先前任务的操作对象和保留原件"""
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    for seed in (1, 2):
+        textured(seed).save(folder / f'{seed}_copy.png')
+        textured(seed).save(folder / f'{seed}_copy.jpg', quality=90)
+    references = {}
+    for seed in (1, 2):
+        references[seed] = str(tmp_path / f'reference_{seed}.png')
+        textured(seed).save(references[seed])
+
+    state = session_state(similarity, client)
+    state.folders = [str(folder)]
+    job_a = run_job(client, state, references[1])
+    job_b = run_job(client, state, references[2])  # 另一个标签页换了参考图片并完成了扫描
+
+    response = client.post('/delete_all_similar', json={'job_id': job_a, 'action': 'hardlink'})
+    assert response.get_json()['deleted_count'] == 2
+    for name in ('1_copy.png', '1_copy.jpg'):
+        assert os.path.samefile(folder / name, references[1])
+    for name in ('2_copy.png', '2_copy.jpg'):
+        assert not os.path.samefile(folder / name, references[2])
+
+    # 撤销日志同样属于任务
+    assert client.post('/undo_last_action', json={'job_id': job_b}).status_code == 400
+    assert client.post('/undo_last_action', json={'job_id': job_a}).get_json()['restored_count'] == 2
+    assert not os.path.samefile(folder / '1_copy.png', references[1])
+
+
+def test_bulk_action_requires_a_job_of_this_session(similarity, client, tmp_path):
+    assert client.post('/delete_all_similar', json={'action': 'delete'}).status_code == 404
+    textured(1).save(tmp_path / 'image.png')
+    other = similarity.app.test_client()
+    other.get('/')
+    other_state = session_state(similarity, other)
+    other_state.folders = [str(tmp_path)]
+    job_id = run_job(other, other_state, str(tmp_path / 'image.png'))
+    assert client.post('/delete_all_similar', json={'job_id': job_id, 'action': 'delete'}).status_code == 404
+
+
+@pytest.mark.parametrize('algorithms', [[], ''])
+def test_empty_algorithm_selection_is_rejected(client, algorithms):
+    response = client.post('/process_images', json={'threshold': 80, 'hash_size': 8, 'algorithms': algorithms})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '至少需要选择一种哈希算法'
@@ -1,15 +1,38 @@
 import sys
 import os
 import itertools
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import gzip
+import json
+import struct
+import zlib
+import multiprocessing
+import shutil
+import errno
+import time
+import uuid
+import io
+import re
+import tarfile
+import zipfile
+import tempfile
+import threading
+import functools
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QPushButton, QLabel, QFileDialog, QProgressBar, QScrollArea, 
                              QGridLayout, QSpinBox, QDoubleSpinBox, QFormLayout, QLineEdit,
-                             QSizePolicy, QFrame)
+                             QSizePolicy, QFrame, QCheckBox, QComboBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSize
 from PyQt6.QtGui import QPixmap, QFont, QIcon, QIntValidator
 from PIL import Image
 import imagehash
+import numpy
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 # ==============================================================================
 #  色彩和样式配置 (无变化)
@@ -84,15 +107,274 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def calculate_hashes_for_image(path, hash_size):
+class HashAlgorithm:
+    """一种感知哈希算法。
+
+    compute(图片, hash_size) 返回 ImageHash，图片已按 mode 转换；shape(hash_size) 给出哈希位矩阵的形状；
+    weight 是综合相似度中的权重；cost 是相对比较开销，评分时先比较便宜的算法。
+    """
+
+    def __init__(self, name, compute, weight, cost=1.0, shape=None, mode='L', supports=None):
+        self.name = name
+        self.compute = compute
+        self.weight = weight
+        self.cost = cost
+        self.shape = shape or (lambda hash_size: (hash_size, hash_size))
+        self.mode = mode
+        self.supports = supports or (lambda hash_size: True)
+
+    def bits(self, hash_size):
+        return int(numpy.prod(self.shape(hash_size)))
+
+    def max_bits(self, hash_size):
+        # 与 calculate_similarity 中 len(str(hash)) * 4 一致：按十六进制位数向上取整
+        return (self.bits(hash_size) + 3) // 4 * 4
+
+HASH_ALGORITHMS = {}
+
+def register_hash_algorithm(algorithm):
+    """注册哈希算法，之后即可在 algorithms 配置（界面勾选、命令行 --algorithms）中使用"""
+    HASH_ALGORITHMS[algorithm.name] = algorithm
+    return algorithm
+
+register_hash_algorithm(HashAlgorithm('phash', lambda img, hash_size: imagehash.phash(img, hash_size=hash_size), 0.5))
+register_hash_algorithm(HashAlgorithm('ahash', lambda img, hash_size: imagehash.average_hash(img, hash_size=hash_size), 0.3))
+register_hash_algorithm(HashAlgorithm('dhash', lambda img, hash_size: imagehash.dhash(img, hash_size=hash_size), 0.2))
+register_hash_algorithm(HashAlgorithm('whash', lambda img, hash_size: imagehash.whash(img, hash_size=hash_size), 0.2,
+                                      cost=1.0, supports=lambda hash_size: hash_size & (hash_size - 1) == 0))
+register_hash_algorithm(HashAlgorithm('colorhash', lambda img, hash_size: imagehash.colorhash(img, binbits=3), 0.2,
+                                      cost=0.5, shape=lambda hash_size: (14, 3), mode='RGB'))
+
+DEFAULT_HASH_ALGORITHMS = ('phash', 'ahash', 'dhash')
+
+def resolve_hash_algorithms(names, hash_size=None):
+    """校验算法配置，返回算法名元组；名称未注册或不支持当前 hash_size 时抛出 ValueError"""
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    names = tuple(dict.fromkeys(names))
+    if not names:
+        raise ValueError("至少需要选择一种哈希算法")
+    for name in names:
+        if name not in HASH_ALGORITHMS:
+            raise ValueError(f"未知的哈希算法: {name}（可用: {', '.join(HASH_ALGORITHMS)}）")
+        if hash_size is not None and not HASH_ALGORITHMS[name].supports(hash_size):
+            raise ValueError(f"哈希算法 {name} 不支持哈希大小 {hash_size}")
+    return names
+
+@functools.lru_cache(maxsize=None)
+def scoring_plan(algorithms):
+    """返回 (评分顺序, 总权重)。顺序按比较开销从低到高，开销相同时权重大的在前，便于尽早判定不可能达到阈值。"""
+    order = sorted(range(len(algorithms)),
+                   key=lambda i: (HASH_ALGORITHMS[algorithms[i]].cost, -HASH_ALGORITHMS[algorithms[i]].weight))
+    return tuple(order), sum(HASH_ALGORITHMS[name].weight for name in algorithms)
+
+# 画质特征：在计算哈希时顺带从同一份解码结果中提取，存入 quality 目录（{路径: 特征字典}）和哈希库，
+# 挑选每组最佳图片时直接读取，不再重新打开图片
+QUALITY_FIELDS = ('sharpness', 'jpeg_quality', 'bit_depth', 'pixels', 'file_size', 'lossless')
+# 组内各特征先除以组内最大值再加权；文件大小只用于打破平局，相同画质时选体积小的，避免选中虚胖的重复保存
+QUALITY_WEIGHTS = {'pixels': 0.4, 'sharpness': 0.35, 'jpeg_quality': 0.15, 'bit_depth': 0.1, 'lossless': 0.05}
+# JPEG 块效应会抬高拉普拉斯方差，比较清晰度前按 (质量/100)^3 打折
+JPEG_SHARPNESS_EXPONENT = 3
+LOSSY_FORMATS = {'JPEG', 'MPO'}
+# 检测无损格式图片是否由 JPEG 解码后另存：只看 (0,1)、(1,0)、(1,1) 三个低频 DCT 系数在 8x8 块上是否集中在量化步长的整数倍
+JPEG_HISTORY_POSITIONS = ((0, 1), (1, 0), (1, 1))
+JPEG_HISTORY_STEPS = range(2, 65)  # 质量约 95 到 10
+JPEG_HISTORY_THRESHOLD = 0.2  # 周期性得分 (cos 均值) 超过它即视为 JPEG 另存；真正的无损图片通常低于 0.1
+JPEG_HISTORY_MAX_BLOCKS = 16384  # 大图只抽样这么多块
+
+# 每个通道的位深
+MODE_BIT_DEPTH = {'1': 1, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I;16N': 16, 'I': 32, 'F': 32}
+
+# libjpeg 质量 50 时的标准亮度量化表（自然顺序，与 PIL 的 quantization 一致）
+JPEG_STANDARD_LUMINANCE = numpy.array([
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99], dtype=numpy.float64)
+
+def laplacian_variance(gray):
+    """4 邻域拉普拉斯响应的方差，越大越清晰。有 OpenCV 时用 cv2.Laplacian，否则用 numpy 切片，两者结果一致。"""
+    pixels = numpy.asarray(gray)
+    if min(pixels.shape) < 3: return 0.0
+    if cv2 is not None:
+        response = cv2.Laplacian(pixels, cv2.CV_32F, ksize=1)[1:-1, 1:-1]
+    else:
+        pixels = pixels.astype(numpy.float32)
+        response = (pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+                    - 4 * pixels[1:-1, 1:-1])
+    return float(response.var(dtype=numpy.float64))
+
+def estimate_jpeg_quality(img):
+    """按亮度量化表相对 libjpeg 标准表的缩放比例反推 JPEG 质量 (1-100)；非 JPEG 视为无损，返回 100。"""
+    tables = getattr(img, 'quantization', None)
+    if not tables or 0 not in tables or len(tables[0]) != 64:
+        return 100.0
+    scale = float(numpy.mean(numpy.asarray(tables[0], dtype=numpy.float64) * 100 / JPEG_STANDARD_LUMINANCE))
+    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+    return float(min(100.0, max(1.0, quality)))
+
+_DCT_BASIS = numpy.array([[numpy.sqrt((1 if k == 0 else 2) / 8) * numpy.cos((2 * n + 1) * k * numpy.pi / 16)
+                           for n in range(8)] for k in range(8)])
+
+def estimate_resaved_jpeg_quality(gray):
+    """无损格式的图片如果是 JPEG 解码后另存的，按检测到的量化步长估计原 JPEG 质量；看不出 JPEG 痕迹时返回 None。
+
+    质量 95 以上的量化步长为 1，检测不到，这类图片与无损图片本就相差无几。
+    """
+    pixels = numpy.asarray(gray)
+    rows, cols = pixels.shape[0] // 8, pixels.shape[1] // 8
+    if not rows or not cols: return None
+    stride = max(1, int(numpy.ceil(rows * cols / JPEG_HISTORY_MAX_BLOCKS)))
+    blocks = pixels[:rows * 8, :cols * 8].reshape(rows, 8, cols, 8)[::stride].astype(numpy.float32) - 128
+    scores, scales = [], []
+    for u, v in JPEG_HISTORY_POSITIONS:
+        coefficients = numpy.einsum('ijkl,jl->ik', blocks, numpy.outer(_DCT_BASIS[u], _DCT_BASIS[v])).ravel()
+        candidates = []
+        for step in JPEG_HISTORY_STEPS:
+            values = coefficients[numpy.abs(coefficients) >= step / 2]
+            # 系数种类太少（如纯渐变，每块完全相同）时周期性没有意义
+            if len(values) < 50 or len(numpy.unique(numpy.round(values))) < 8: continue
+            candidates.append((float(numpy.cos(2 * numpy.pi * values / step).mean()), step))
+        if not candidates:
+            scores.append(0.0)
+            continue
+        best = max(score for score, _ in candidates)
+        # 步长的约数同样得分很高，取得分接近最高分的最大步长
+        step = max(step for score, step in candidates if score >= 0.9 * best)
+        scores.append(best)
+        # 量化表项是 标准值×缩放/100 四舍五入得到的，取步长对应缩放的上界，估计出的质量不会高于原 JPEG
+        scales.append((step + 0.5) * 100 / JPEG_STANDARD_LUMINANCE[u * 8 + v])
+    if numpy.mean(scores) < JPEG_HISTORY_THRESHOLD or not scales:
+        return None
+    scale = float(numpy.mean(scales))
+    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+    return float(min(100.0, max(1.0, quality)))
+
+def measure_image_quality(img, gray, path, fileobj=None):
+    """img 为刚打开的原图（读取量化表和模式），gray 为计算哈希用的灰度图"""
+    if fileobj is not None:
+        position = fileobj.tell()
+        file_size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+    else:
+        file_size = os.path.getsize(path)
+    jpeg_quality, lossless = estimate_jpeg_quality(img), img.format not in LOSSY_FORMATS
+    if lossless:
+        # PNG 等格式也可能只是 JPEG 的另存，此时按原 JPEG 的质量计，不算无损
+        resaved_quality = estimate_resaved_jpeg_quality(gray)
+        if resaved_quality is not None:
+            jpeg_quality, lossless = resaved_quality, False
+    return {
+        'sharpness': laplacian_variance(gray),
+        'jpeg_quality': jpeg_quality,
+        'bit_depth': float(MODE_BIT_DEPTH.get(img.mode, 8)),
+        'pixels': float(img.size[0] * img.size[1]),
+        'file_size': float(file_size),
+        'lossless': float(lossless),
+    }
+
+def calculate_hashes_for_image(path, hash_size, fileobj=None, algorithms=DEFAULT_HASH_ALGORITHMS, quality=None):
+    """只计算 algorithms 中列出的哈希，返回 (path, 哈希元组)，顺序与 algorithms 一致。
+
+    传入 quality 字典时，同时把画质特征写入 quality[path]。
+    """
     try:
-        img = Image.open(path).convert('L')
-        phash = imagehash.phash(img, hash_size=hash_size)
-        ahash = imagehash.average_hash(img, hash_size=hash_size)
-        dhash = imagehash.dhash(img, hash_size=hash_size)
-        return path, (phash, ahash, dhash)
+        img = Image.open(fileobj or path)
+        converted = {}
+        hashes = []
+        for name in algorithms:
+            algorithm = HASH_ALGORITHMS[name]
+            if algorithm.mode not in converted:
+                converted[algorithm.mode] = img.convert(algorithm.mode)
+            hashes.append(algorithm.compute(converted[algorithm.mode], hash_size))
+        if quality is not None:
+            quality[path] = measure_image_quality(img, converted['L'] if 'L' in converted else img.convert('L'), path, fileobj)
+        return path, tuple(hashes)
     except Exception:
-        return path, (None, None, None)
+        return path, (None,) * len(algorithms)
+
+# 8 种二面体方向 (转置, 上下翻转, 左右翻转)，第一个是原图
+ORIENTATIONS = [(transpose, flip_rows, flip_cols)
+                for transpose in (False, True) for flip_rows in (False, True) for flip_cols in (False, True)]
+
+def orient_pixels(matrix, orientation):
+    transpose, flip_rows, flip_cols = orientation
+    if transpose: matrix = matrix.T
+    if flip_rows: matrix = matrix[::-1, :]
+    if flip_cols: matrix = matrix[:, ::-1]
+    return matrix
+
+def orient_dct(dct, orientation):
+    # DCT-II 的性质：像素矩阵翻转等价于奇数频率系数取反，转置等价于系数矩阵转置
+    transpose, flip_rows, flip_cols = orientation
+    if transpose: dct = dct.T
+    signs = 1 - 2 * (numpy.arange(dct.shape[0]) % 2)
+    if flip_rows: dct = dct * signs[:, None]
+    if flip_cols: dct = dct * signs[None, :]
+    return dct
+
+def orient_image(img, orientation):
+    transpose, flip_rows, flip_cols = orientation
+    if transpose: img = img.transpose(Image.Transpose.TRANSPOSE)
+    if flip_rows: img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    if flip_cols: img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    return img
+
+def derived_orientation_hashes(img, hash_size, names):
+    """phash/ahash/dhash 的 8 个方向直接由缩小后的矩阵和 DCT 系数推导，返回 {算法名: [各方向哈希]}"""
+    import scipy.fftpack
+    img = img.convert('L')
+    derived = {name: [] for name in names}
+    # 与 imagehash 相同的缩小方式，只缩小一次，各方向都从这几个小矩阵推导
+    if 'phash' in names:
+        img_size = hash_size * 4
+        pixels = numpy.asarray(img.resize((img_size, img_size), imagehash.ANTIALIAS))
+        dct_low = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)[:hash_size, :hash_size]
+    if 'ahash' in names:
+        average = numpy.asarray(img.resize((hash_size, hash_size), imagehash.ANTIALIAS))
+    if 'dhash' in names:
+        wide = numpy.asarray(img.resize((hash_size + 1, hash_size), imagehash.ANTIALIAS))
+        tall = numpy.asarray(img.resize((hash_size, hash_size + 1), imagehash.ANTIALIAS))
+
+    for orientation in ORIENTATIONS:
+        if 'phash' in names:
+            dct = orient_dct(dct_low, orientation)
+            derived['phash'].append(imagehash.ImageHash(dct > numpy.median(dct)))
+        if 'ahash' in names:
+            oriented_average = orient_pixels(average, orientation)
+            derived['ahash'].append(imagehash.ImageHash(oriented_average > numpy.mean(oriented_average)))
+        if 'dhash' in names:
+            # 转置后原图的"高"方向变成了差分方向，所以使用 (hash_size+1) 行的缩小结果
+            diff_source = orient_pixels(tall if orientation[0] else wide, orientation)
+            derived['dhash'].append(imagehash.ImageHash(diff_source[:, 1:] > diff_source[:, :-1]))
+    return derived
+
+DERIVED_ORIENTATION_ALGORITHMS = ('phash', 'ahash', 'dhash')
+
+def calculate_hash_variants(path, hash_size, orientations=False, fileobj=None, algorithms=DEFAULT_HASH_ALGORITHMS,
+                            quality=None):
+    """返回 (path, [哈希元组, ...])。开启 orientations 时一次解码得到 8 个方向的哈希，第一个与 calculate_hashes_for_image 相同。"""
+    if not orientations:
+        path, hash_tuple = calculate_hashes_for_image(path, hash_size, fileobj, algorithms, quality)
+        return path, [hash_tuple]
+    try:
+        img = Image.open(fileobj or path)
+        img.load()
+        gray = img.convert('L')
+        per_algorithm = derived_orientation_hashes(
+            gray, hash_size, [name for name in algorithms if name in DERIVED_ORIENTATION_ALGORITHMS])
+        # 其他算法没有推导方法，对旋转/翻转后的图片重新计算
+        for name in algorithms:
+            if name not in per_algorithm:
+                algorithm = HASH_ALGORITHMS[name]
+                converted = img.convert(algorithm.mode)
+                per_algorithm[name] = [algorithm.compute(orient_image(converted, orientation), hash_size)
+                                       for orientation in ORIENTATIONS]
+        if quality is not None:
+            quality[path] = measure_image_quality(img, gray, path, fileobj)
+        return path, [tuple(per_algorithm[name][k] for name in algorithms) for k in range(len(ORIENTATIONS))]
+    except Exception:
+        return path, [(None,) * len(algorithms)]
 
 def calculate_similarity(hash1, hash2):
     if not hash1 or not hash2: return 0
@@ -100,12 +382,1118 @@ def calculate_similarity(hash1, hash2):
     max_bits = len(str(hash1)) * 4
     return (1 - distance / max_bits) * 100
 
-def get_best_image_in_group(group):
+def get_max_phash_dist(hash_size, threshold):
+    # 只有当两张图片的phash距离小于这个值时，我们才进行完整的比较
+    return int((hash_size**2) * (1 - (threshold - 10) / 100))
+
+# 浮点累加误差的容差，剪枝只在确定达不到阈值时发生
+SCORE_EPSILON = 1e-9
+
+def is_similar_pair(hashes1, hashes2, threshold, max_phash_dist, algorithms=DEFAULT_HASH_ALGORITHMS):
+    if hashes1[0] is None or hashes2[0] is None: return False
+
+    # *** 性能优化：快速预检 ***
+    if 'phash' in algorithms:
+        index = algorithms.index('phash')
+        if (hashes1[index] - hashes2[index]) > max_phash_dist:
+            return False
+
+    # 只有通过了快速预检的图片对，才进行完整计算：按开销从低到高累加加权相似度，
+    # 剩余算法即使全部 100% 相似也达不到阈值时立即返回
+    order, total_weight = scoring_plan(algorithms)
+    combined_sim, remaining_weight = 0.0, total_weight
+    for index in order:
+        weight = HASH_ALGORITHMS[algorithms[index]].weight
+        combined_sim += calculate_similarity(hashes1[index], hashes2[index]) * weight
+        remaining_weight -= weight
+        if combined_sim + remaining_weight * 100 < threshold * total_weight - SCORE_EPSILON:
+            return False
+    return combined_sim / total_weight >= threshold
+
+def matches_any_orientation(variants1, variants2, threshold, max_phash_dist, algorithms=DEFAULT_HASH_ALGORITHMS):
+    """任意一张图的原图与另一张图的任一方向相似即视为相似。双向检查保证结果与比较顺序无关，比较次数只增加常数倍。"""
+    hashes1, hashes2 = variants1[0], variants2[0]
+    return (any(is_similar_pair(hashes1, oriented, threshold, max_phash_dist, algorithms) for oriented in variants2) or
+            any(is_similar_pair(hashes2, oriented, threshold, max_phash_dist, algorithms) for oriented in variants1[1:]))
+
+def collect_image_sources(folder_paths, include=None, exclude=None, max_depth=None, dir_index=None):
+    """收集图片文件和压缩包。压缩包中的图片在计算哈希时逐个流式读取。遍历参数见 walk_files。"""
+    return walk_files(folder_paths, lambda name: allowed_file(name) or is_archive(name),
+                      include, exclude, max_depth, dir_index)
+
+def calculate_source_variants(source, hash_size, orientations=False, algorithms=DEFAULT_HASH_ALGORITHMS, quality=None):
+    """计算一个来源的哈希：普通图片返回一项，压缩包返回其中每张图片，格式为 [(标识, [哈希元组, ...]), ...]。"""
+    if is_archive(source):
+        return [calculate_hash_variants(identifier, hash_size, orientations, fileobj, algorithms, quality)
+                for identifier, fileobj in iter_archive_images(source)]
+    return [calculate_hash_variants(source, hash_size, orientations, None, algorithms, quality)]
+
+# 分组方式：连通分量会沿相似链把连拍、渐进编辑等成千上万张图片串成一个大组，
+# 另外两种方式以中心图片为圆心聚类，限制组的直径
+CLUSTERING_MODES = {
+    'connected': "连通分量（传递合并）",
+    'leader': "中心聚类（每张都与中心相似）",
+    'complete': "完全链接（组内两两相似）",
+}
+DEFAULT_CLUSTERING = 'connected'
+
+def union_find_groups(similar_pairs):
+    parent = {}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for p1, p2 in similar_pairs:
+        parent.setdefault(p1, p1); parent.setdefault(p2, p2)
+        root1, root2 = find(p1), find(p2)
+        if root1 != root2:
+            parent[root2] = root1
+
+    groups = {}
+    for node in parent:
+        groups.setdefault(find(node), []).append(node)
+    return [group for group in groups.values() if len(group) > 1]
+
+def rank_group(group, quality=None):
+    """按画质从好到坏排序。组内所有图片都有画质特征时只读 quality，否则退回按 文件大小×像素数 打开图片比较。"""
+    group = sorted(group)  # 得分相同时按路径排序，结果与分组顺序无关
+    records = [quality.get(p) for p in group] if quality else []
+    if records and all(records):
+        features = []
+        for record in records:
+            # 旧记录没有 lossless，按 JPEG 质量估计为 100 视为无损
+            lossless = record.get('lossless', float(record['jpeg_quality'] >= 100))
+            fidelity = 1.0 if lossless else record['jpeg_quality'] / 100
+            # 像素数按边长（平方根）比较，缩小一半的副本不至于被过度惩罚，放大的副本也占不到太多便宜
+            features.append(dict(record, lossless=lossless, jpeg_quality=fidelity * 100,
+                                 sharpness=record['sharpness'] * fidelity ** JPEG_SHARPNESS_EXPONENT,
+                                 pixels=record['pixels'] ** 0.5))
+        maxima = {field: max(feature[field] for feature in features) or 1.0 for field in QUALITY_WEIGHTS}
+        def score(feature):
+            return (sum(weight * feature[field] / maxima[field] for field, weight in QUALITY_WEIGHTS.items()),
+                    -feature['file_size'])
+        return [path for _, path in sorted(zip(features, group), key=lambda item: score(item[0]), reverse=True)]
+    try:
+        def score(p):
+            with open_image_source(p) as img:
+                return image_source_size(p) * img.size[0] * img.size[1]
+        return sorted(group, key=score, reverse=True)
+    except (FileNotFoundError, OSError, KeyError, tarfile.TarError, zipfile.BadZipFile):
+        return list(group)
+
+def get_best_image_in_group(group, quality=None):
     if not group: return None
+    return rank_group(group, quality)[0]
+
+# ==============================================================================
+#  目录遍历：多线程 os.scandir，支持包含/排除通配符、深度限制和持久化的目录 mtime 索引
+# ==============================================================================
+DIR_INDEX_VERSION = 1
+DIR_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.image_comparator', 'dir_index.json.gz')
+DIR_INDEX_SETTLE_NS = 2 * 10 ** 9  # 刚修改过的目录不写入索引，避免同一 mtime 精度内的后续修改被漏掉
+
+class DirectoryIndex:
+    """持久化的目录列表缓存：{目录: [mtime_ns, 文件名列表, 子目录名列表]}，保存为 gzip JSON。
+
+    目录的 mtime 只在其直接子项增删或改名时变化，所以 mtime 未变的目录直接复用上次的列表而不再 scandir；
+    更深层的变化要看各子目录自己的 mtime，因此每个子目录仍需一次 stat。
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if index_path and os.path.exists(index_path):
+            try:
+                with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == DIR_INDEX_VERSION:
+                    self.entries = data['directories']
+            except (OSError, ValueError, KeyError):
+                self.entries = {}
+
+    def lookup(self, path, mtime_ns):
+        entry = self.entries.get(path)
+        if entry and entry[0] == mtime_ns:
+            return entry[1], entry[2]
+        return None
+
+    def store(self, path, mtime_ns, files, dirs):
+        if time.time_ns() - mtime_ns < DIR_INDEX_SETTLE_NS:
+            return
+        with self.lock:
+            self.entries[path] = [mtime_ns, files, dirs]
+            self.dirty = True
+
+    def prune(self, roots, visited):
+        """删除这些根目录下本次没有遍历到（已删除）的目录"""
+        prefixes = [os.path.join(root, '') for root in roots]
+        with self.lock:
+            stale = [path for path in self.entries
+                     if path not in visited and any(path.startswith(prefix) for prefix in prefixes)]
+            for path in stale:
+                del self.entries[path]
+            self.dirty = self.dirty or bool(stale)
+
+    def save(self):
+        if not self.index_path or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump({'version': DIR_INDEX_VERSION, 'directories': self.entries}, f,
+                          ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+
+def scan_directory(path, mtime_ns, dir_index=None):
+    """返回目录的 (文件名列表, [(子目录名, mtime_ns), ...])。子目录的 mtime 取自 DirEntry 的 stat。"""
+    key = os.path.abspath(path)
+    cached = dir_index.lookup(key, mtime_ns) if dir_index else None
+    if cached:
+        files, names = cached
+        dirs = []
+        for name in names:
+            try:
+                dirs.append((name, os.stat(os.path.join(path, name)).st_mtime_ns))
+            except OSError:
+                continue
+        return files, dirs
+
+    files, dirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append((entry.name, entry.stat(follow_symlinks=False).st_mtime_ns))
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                continue
+    if dir_index:
+        dir_index.store(key, mtime_ns, files, [name for name, _ in dirs])
+    return files, dirs
+
+def match_globs(relative_path, name, patterns):
+    # 含 '/' 的通配符匹配相对路径，否则只匹配名称
+    return any(fnmatch.fnmatch(relative_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+def walk_files(folder_paths, match=None, include=None, exclude=None, max_depth=None, dir_index=None,
+               max_workers=None):
+    """多线程遍历文件夹，返回满足 match(文件名) 和包含/排除通配符的文件路径（已排序、去重）。
+
+    include 只作用于文件；exclude 同时作用于文件和目录，被排除的目录整棵跳过。
+    max_depth 为 0 时只看根目录中的文件。隔离区目录始终跳过。
+    """
+    include, exclude = list(include or []), list(exclude or [])
+    # 统一成绝对路径，相对路径和绝对路径写法的同一（或嵌套）文件夹才能去重
+    folder_paths = list(dict.fromkeys(os.path.abspath(folder_path) for folder_path in folder_paths))
+    results, visited = [], set()
+    with ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 4) * 4)) as executor:
+        pending = {}
+        for folder_path in folder_paths:
+            try:
+                mtime_ns = os.stat(folder_path).st_mtime_ns
+            except OSError:
+                continue
+            pending[executor.submit(scan_directory, folder_path, mtime_ns, dir_index)] = (folder_path, '', 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path, relative, depth = pending.pop(future)
+                try:
+                    files, dirs = future.result()
+                except OSError:
+                    continue
+                visited.add(os.path.abspath(dir_path))
+                for name in files:
+                    if match and not match(name): continue
+                    if include and not match_globs(relative + name, name, include): continue
+                    if exclude and match_globs(relative + name, name, exclude): continue
+                    results.append(os.path.join(dir_path, name))
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for name, mtime_ns in dirs:
+                    if name == QUARANTINE_DIRNAME: continue
+                    if exclude and match_globs(relative + name, name, exclude): continue
+                    sub_path = os.path.join(dir_path, name)
+                    pending[executor.submit(scan_directory, sub_path, mtime_ns, dir_index)] = \
+                        (sub_path, f"{relative}{name}/", depth + 1)
+    if dir_index:
+        if max_depth is None and not exclude:
+            dir_index.prune(folder_paths, visited)
+        dir_index.save()
+    return sorted(set(results))  # 选中的文件夹互相嵌套时同一文件会被找到两次
+
+def split_globs(text):
+    """把用分号分隔的通配符字符串拆成列表"""
+    return [pattern.strip() for pattern in (text or '').split(';') if pattern.strip()]
+
+# ==============================================================================
+#  压缩包扫描：不解压到磁盘，直接从 zip/tar 中流式读取图片，标识为 "压缩包!成员"
+# ==============================================================================
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_SEPARATOR = '!'
+MAX_ARCHIVE_MEMBER_SIZE = 256 * 1024 * 1024  # 单个成员读入内存的上限
+_ARCHIVE_IDENTIFIER = re.compile(
+    r'^(.*?(?:' + '|'.join(re.escape(ext) for ext in ARCHIVE_EXTENSIONS) + r'))' + re.escape(ARCHIVE_SEPARATOR) + r'(.+)$',
+    re.IGNORECASE)
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def split_archive_identifier(identifier):
+    """把 "压缩包!成员" 拆成 (压缩包路径, 成员名)，普通文件返回 None。"""
+    match = _ARCHIVE_IDENTIFIER.match(identifier)
+    if match and os.path.isfile(match.group(1)):
+        return match.group(1), match.group(2)
+    return None
+
+def iter_archive_images(archive_path):
+    """按顺序流式读取压缩包中的图片，产出 (标识, 内存文件)。同一时间只持有一个成员的数据。"""
     try:
-        return max(group, key=lambda p: os.path.getsize(p) * Image.open(p).size[0] * Image.open(p).size[1])
-    except (FileNotFoundError, OSError):
-        return group[0]
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not allowed_file(info.filename) or info.file_size > MAX_ARCHIVE_MEMBER_SIZE:
+                        continue
+                    yield f"{archive_path}{ARCHIVE_SEPARATOR}{info.filename}", io.BytesIO(archive.read(info))
+        else:
+            # 流模式只顺序读取一遍，压缩的 tar 也不需要回退
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or not allowed_file(member.name) or member.size > MAX_ARCHIVE_MEMBER_SIZE:
+                        continue
+                    yield f"{archive_path}{ARCHIVE_SEPARATOR}{member.name}", io.BytesIO(archive.extractfile(member).read())
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+        print(f"Error reading archive {archive_path}: {e}", file=sys.stderr)  # 标准输出留给命令行的 JSON 结果
+
+def read_image_bytes(identifier):
+    """读取图片的原始字节，支持压缩包成员。"""
+    archive_member = split_archive_identifier(identifier)
+    if not archive_member:
+        with open(identifier, 'rb') as f:
+            return f.read()
+    archive_path, member_name = archive_member
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.read(member_name)
+    with tarfile.open(archive_path, 'r:*') as archive:
+        return archive.extractfile(member_name).read()
+
+def open_image_source(identifier):
+    if split_archive_identifier(identifier):
+        return Image.open(io.BytesIO(read_image_bytes(identifier)))
+    return Image.open(identifier)
+
+def image_source_size(identifier):
+    archive_member = split_archive_identifier(identifier)
+    if not archive_member:
+        return os.path.getsize(identifier)
+    archive_path, member_name = archive_member
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.getinfo(member_name).file_size
+    with tarfile.open(archive_path, 'r:*') as archive:
+        return archive.getmember(member_name).size
+
+# ==============================================================================
+#  分片扫描与合并：每个分片输出紧凑的哈希表，合并阶段做跨分片比较和并查集分组
+# ==============================================================================
+SHARD_FORMAT = 'similarity-shard'
+SHARD_VERSION = 1
+
+def shard_for_path(path, num_shards):
+    """按路径的稳定哈希分配分片。多台机器只要看到相同的路径字符串，无需协调就能各自挑出自己的分片。"""
+    return zlib.crc32(os.path.normcase(path).encode('utf-8')) % num_shards
+
+def hash_to_hex(image_hash):
+    return str(image_hash) if image_hash is not None else None
+
+def hex_to_hash(hex_str, hash_size, shape=None):
+    """把 str(ImageHash) 还原成 ImageHash（imagehash.hex_to_hash 对非 8 的倍数尺寸不可靠）。
+
+    shape 默认为 hash_size x hash_size，其他形状（如 colorhash）由 HashAlgorithm.shape 给出。
+    """
+    if hex_str is None: return None
+    shape = shape or (hash_size, hash_size)
+    bits = int(numpy.prod(shape))
+    raw = int(hex_str, 16).to_bytes((bits + 7) // 8, 'big')
+    flat = numpy.unpackbits(numpy.frombuffer(raw, dtype=numpy.uint8))[-bits:]
+    return imagehash.ImageHash(flat.astype(bool).reshape(shape))
+
+def hex_to_hash_tuple(hex_tuple, hash_size, algorithms):
+    return tuple(hex_to_hash(h, hash_size, HASH_ALGORITHMS[name].shape(hash_size))
+                 for h, name in zip(hex_tuple, algorithms))
+
+def scan_shard(sources, hash_size, threshold, output_path, shard_index=0, num_shards=1, orientations=False,
+               algorithms=DEFAULT_HASH_ALGORITHMS):
+    """计算一个分片内所有图片的哈希值和分片内的相似对，写入 gzip 压缩的 JSON 分片文件。"""
+    quality = {}
+    results = dict(item for source in sorted(set(sources))
+                   for item in calculate_source_variants(source, hash_size, orientations, algorithms, quality))
+    image_paths = sorted(results)
+    variants = [results[path] for path in image_paths]
+    hashes = [hash_variants[0] for hash_variants in variants]
+    max_phash_dist = get_max_phash_dist(hash_size, threshold)
+
+    pairs = []
+    for i in range(len(image_paths)):
+        if not hashes[i][0]: continue
+        for j in range(i + 1, len(image_paths)):
+            if matches_any_orientation(variants[i], variants[j], threshold, max_phash_dist, algorithms):
+                pairs.append((i, j))
+
+    shard = {
+        'format': SHARD_FORMAT,
+        'version': SHARD_VERSION,
+        'hash_size': hash_size,
+        'algorithms': list(algorithms),
+        'threshold': threshold,
+        'shard_index': shard_index,
+        'num_shards': num_shards,
+        'paths': image_paths,
+        'hashes': [[hash_to_hex(h) for h in hash_tuple] if hash_tuple[0] is not None else None for hash_tuple in hashes],
+        'pairs': pairs,
+        'quality': [quality.get(path) for path in image_paths],
+    }
+    if orientations:
+        shard['variants'] = [[[hash_to_hex(h) for h in hash_tuple] for hash_tuple in hash_variants[1:]]
+                             if hash_variants[0][0] is not None else [] for hash_variants in variants]
+    with gzip.open(output_path, 'wt', encoding='utf-8') as f:
+        json.dump(shard, f, ensure_ascii=False, separators=(',', ':'))
+    return output_path
+
+def load_shard(shard_path):
+    with gzip.open(shard_path, 'rt', encoding='utf-8') as f:
+        shard = json.load(f)
+    if shard.get('format') != SHARD_FORMAT or shard.get('version') != SHARD_VERSION:
+        raise ValueError(f"不支持的分片文件: {shard_path}")
+    hash_size = shard['hash_size']
+    algorithms = shard['algorithms'] = tuple(shard.get('algorithms', DEFAULT_HASH_ALGORITHMS))
+    shard['hashes'] = [hex_to_hash_tuple(hex_tuple, hash_size, algorithms) if hex_tuple else (None,) * len(algorithms)
+                       for hex_tuple in shard['hashes']]
+    # 每张图片的所有方向，没有方向信息时只有原图
+    extra = shard.get('variants') or [[] for _ in shard['hashes']]
+    shard['variants'] = [[hash_tuple] + [hex_to_hash_tuple(hex_tuple, hash_size, algorithms) for hex_tuple in hex_variants]
+                         for hash_tuple, hex_variants in zip(shard['hashes'], extra)]
+    return shard
+
+_shard_cache = None  # 合并进程池中每个工作进程已解析的分片 {路径: 分片}
+
+def _init_shard_cache():
+    global _shard_cache
+    _shard_cache = {}
+
+def cached_shard(shard_path):
+    """在合并进程池中每个分片每个进程只解析一次，其他情况直接读取。"""
+    if _shard_cache is None:
+        return load_shard(shard_path)
+    if shard_path not in _shard_cache:
+        _shard_cache[shard_path] = load_shard(shard_path)
+    return _shard_cache[shard_path]
+
+def compare_shards(shard_path_a, shard_path_b):
+    """比较两个分片之间的所有图片对，返回跨分片的相似路径对。"""
+    shard_a, shard_b = cached_shard(shard_path_a), cached_shard(shard_path_b)
+    threshold, hash_size, algorithms = shard_a['threshold'], shard_a['hash_size'], shard_a['algorithms']
+    max_phash_dist = get_max_phash_dist(hash_size, threshold)
+
+    pairs = []
+    for path1, variants1 in zip(shard_a['paths'], shard_a['variants']):
+        if not variants1[0][0]: continue
+        for path2, variants2 in zip(shard_b['paths'], shard_b['variants']):
+            if matches_any_orientation(variants1, variants2, threshold, max_phash_dist, algorithms):
+                pairs.append((path1, path2))
+    return pairs
+
+def drain_futures(executor, futures, on_result, should_stop=None, poll_interval=0.5):
+    """等待 futures 全部完成，每完成一个调用 on_result(结果, 已完成数)。
+
+    should_stop() 返回 True 时取消尚未开始的任务、不等待正在运行的任务，返回 False。
+    """
+    pending, done_count = set(futures), 0
+    while pending:
+        if should_stop and should_stop():
+            for future in pending:
+                future.cancel()
+            return False
+        done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            done_count += 1
+            on_result(future.result(), done_count)
+    return True
+
+def merge_shards(shard_paths, max_workers=None, quality=None, clustering=DEFAULT_CLUSTERING, progress=None,
+                 should_stop=None):
+    """合并分片结果：读取分片内相似对，并行做跨分片比较，最后用并查集分组。结果与单进程扫描一致。
+
+    传入 quality 字典时，把分片中记录的画质特征一并读出。
+    progress(percent, status) 按完成的分片对报告 0-100 的进度；should_stop() 返回 True 时中止并返回 None。
+    """
+    progress = progress or (lambda percent, status: None)
+    similar_pairs = []
+    settings = None
+    for shard_path in shard_paths:
+        shard = load_shard(shard_path)
+        if settings is None:
+            settings = (shard['hash_size'], shard['threshold'], shard['algorithms'])
+        elif settings != (shard['hash_size'], shard['threshold'], shard['algorithms']):
+            raise ValueError(f"分片参数不一致: {shard_path}")
+        paths = shard['paths']
+        similar_pairs.extend((paths[i], paths[j]) for i, j in shard['pairs'])
+        if quality is not None:
+            quality.update((path, record) for path, record in zip(paths, shard.get('quality') or []) if record)
+
+    shard_pairs = list(itertools.combinations(shard_paths, 2))
+    if shard_pairs:
+        def collect(pairs, done):
+            similar_pairs.extend(pairs)
+            progress(int(done / len(shard_pairs) * 100), f"跨分片比较: {done}/{len(shard_pairs)}")
+
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_shard_cache)
+        completed = False
+        try:
+            completed = drain_futures(executor, [executor.submit(compare_shards, a, b) for a, b in shard_pairs],
+                                      collect, should_stop)
+        finally:
+            executor.shutdown(wait=completed)
+        if not completed:
+            return None
+
+    return group_pairs(similar_pairs, clustering)
+
+def run_sharded_scan(folder_paths, threshold, hash_size, num_shards, work_dir, max_workers=None, orientations=False,
+                     algorithms=DEFAULT_HASH_ALGORITHMS, walk_options=None, quality=None, clustering=DEFAULT_CLUSTERING,
+                     progress=None, should_stop=None):
+    """在本机用多个进程跑分片扫描并合并，返回相似组。
+
+    progress(percent, status) 报告进度；should_stop() 返回 True 时中止并返回 None。
+    """
+    progress = progress or (lambda percent, status: None)
+    shards = [[] for _ in range(num_shards)]
+    for source in collect_image_sources(folder_paths, **(walk_options or {})):
+        shards[shard_for_path(source, num_shards)].append(source)
+
+    os.makedirs(work_dir, exist_ok=True)
+    shard_paths = [os.path.join(work_dir, f"shard-{i:04d}.json.gz") for i in range(num_shards)]
+    progress(0, f"阶段 1/3: 正在使用 {num_shards} 个进程分片扫描...")
+    executor = ProcessPoolExecutor(max_workers=max_workers or num_shards)
+    completed = False
+    try:
+        futures = [executor.submit(scan_shard, shards[i], hash_size, threshold, shard_paths[i], i, num_shards,
+                                   orientations, algorithms)
+                   for i in range(num_shards)]
+        completed = drain_futures(executor, futures,
+                                  lambda _, done: progress(int(done / num_shards * 60), f"分片扫描: {done}/{num_shards}"),
+                                  should_stop)
+    finally:
+        executor.shutdown(wait=completed)
+    if not completed:
+        return None
+
+    progress(60, "阶段 2/3: 正在跨分片比较...")
+    return merge_shards(shard_paths, max_workers, quality, clustering,
+                        lambda percent, status: progress(60 + int(percent * 0.3), status), should_stop)
+
+# ==============================================================================
+#  二进制哈希库：头部 + 定宽 uint64 哈希列 + 路径字符串表，可直接 numpy.memmap
+# ==============================================================================
+#  文件布局（小端序）:
+#    MAGIC(8) | 版本 uint32 | 头部长度 uint32 | 头部 JSON | 填充到 64 字节对齐 | 数据区
+#  头部 JSON 记录 hash_size、图片数量、每个哈希占用的 uint64 个数，以及每一列和字符串表
+#  在数据区内的偏移。哈希按 str(ImageHash) 的位顺序存放，高位在前的 uint64 放在前面。
+#  'quality' 列为 (图片数, len(quality_fields)) 的 float64，计算失败的图片为 NaN。
+HASH_DB_MAGIC = b'SIMHASHD'
+HASH_DB_VERSION = 1
+HASH_DB_PREAMBLE = struct.Struct('<8sII')
+HASH_DB_ALIGN = 64
+
+_POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+def popcount64(words):
+    """统计 (..., W) uint64 数组最后一维的置位总数。"""
+    bytes_view = numpy.ascontiguousarray(words).view(numpy.uint8)
+    return _POPCOUNT_TABLE[bytes_view].sum(axis=-1, dtype=numpy.int64)
+
+def hash_words(hash_size, algorithm='phash'):
+    return (HASH_ALGORITHMS[algorithm].bits(hash_size) + 63) // 64
+
+def hash_to_words(image_hash, words):
+    value = int(str(image_hash), 16)
+    return [(value >> (64 * (words - 1 - k))) & 0xFFFFFFFFFFFFFFFF for k in range(words)]
+
+def words_to_hash(row, hash_size, shape=None):
+    value = 0
+    for word in row:
+        value = (value << 64) | int(word)
+    return hex_to_hash(f"{value:x}", hash_size, shape)
+
+def _align(offset):
+    return (offset + HASH_DB_ALIGN - 1) // HASH_DB_ALIGN * HASH_DB_ALIGN
+
+def orientation_column(name, k):
+    return name if k == 0 else f"{name}@{k}"
+
+class HashDbWriter:
+    """逐张追加图片哈希并写出二进制哈希库。
+
+    各列先在内存中缓冲，超出内存预算（或调用 flush）时追加写到临时列文件，
+    close 时再按哈希库布局拼接，因此写出任意大小的哈希库都只占用有限内存。
+    """
+
+    def __init__(self, db_path, hash_size, orientations=1, budget=None, algorithms=DEFAULT_HASH_ALGORITHMS):
+        self.db_path = db_path
+        self.hash_size = hash_size
+        self.words = hash_words(hash_size)
+        self.algorithms = tuple(algorithms)
+        self.algorithm_words = {name: hash_words(hash_size, name) for name in self.algorithms}
+        self.orientations = orientations
+        self.budget = budget
+        self.count = 0
+        self.string_size = 0
+        self.names = [orientation_column(name, k) for k in range(orientations) for name in self.algorithms]
+        self.names += ['valid', 'quality', 'string_offsets']
+        self.spill_dir = tempfile.mkdtemp(prefix='.simdb-', dir=os.path.dirname(os.path.abspath(db_path)))
+        self._buffers = {name: [] for name in self.names}
+        self._buffers['string_offsets'].append(0)
+        self._strings = []
+        self._buffered_bytes = 0
+
+    def add(self, path, hash_variants, quality=None):
+        """hash_variants 为 [(phash, ahash, dhash), ...]，第 0 个为原方向；计算失败时为 [(None, None, None)]。
+
+        quality 为 measure_image_quality 返回的特征字典，没有时记为 NaN。
+        """
+        encoded = path.encode('utf-8')
+        row_bytes = (self.orientations * sum(self.algorithm_words.values()) + len(QUALITY_FIELDS)) * 8 + 16 + len(encoded)
+        if self.budget and not self.budget.reserve(row_bytes):
+            self.flush()
+            self.budget.reserve(row_bytes)
+        self._buffered_bytes += row_bytes
+
+        valid = hash_variants[0][0] is not None
+        self._buffers['valid'].append(int(valid))
+        self._buffers['quality'].append([quality[field] for field in QUALITY_FIELDS] if quality
+                                        else [numpy.nan] * len(QUALITY_FIELDS))
+        for k in range(self.orientations):
+            hash_tuple = hash_variants[k] if valid else (None,) * len(self.algorithms)
+            for name, image_hash in zip(self.algorithms, hash_tuple):
+                words = self.algorithm_words[name]
+                self._buffers[orientation_column(name, k)].append(
+                    hash_to_words(image_hash, words) if image_hash is not None else [0] * words)
+        self.string_size += len(encoded)
+        self._buffers['string_offsets'].append(self.string_size)
+        self._strings.append(encoded)
+        self.count += 1
+
+    def flush(self):
+        """把缓冲的行追加写到临时列文件并释放内存"""
+        dtypes = {'valid': numpy.uint8, 'quality': '<f8', 'string_offsets': '<u8'}
+        for name, rows in self._buffers.items():
+            if rows:
+                with open(os.path.join(self.spill_dir, name), 'ab') as f:
+                    f.write(numpy.array(rows, dtype=dtypes.get(name, '<u8')).tobytes())
+                rows.clear()
+        if self._strings:
+            with open(os.path.join(self.spill_dir, 'strings'), 'ab') as f:
+                f.write(b''.join(self._strings))
+            self._strings.clear()
+        if self.budget:
+            self.budget.release(self._buffered_bytes)
+        self._buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        columns, offset = {}, 0
+        for name in self.names:
+            if name == 'valid':
+                dtype, shape = numpy.dtype(numpy.uint8), [self.count]
+            elif name == 'quality':
+                dtype, shape = numpy.dtype('<f8'), [self.count, len(QUALITY_FIELDS)]
+            elif name == 'string_offsets':
+                dtype, shape = numpy.dtype('<u8'), [self.count + 1]
+            else:
+                dtype, shape = numpy.dtype('<u8'), [self.count, self.algorithm_words[name.split('@')[0]]]
+            columns[name] = {'dtype': dtype.str, 'shape': shape, 'offset': offset}
+            offset = _align(offset + int(numpy.prod(shape)) * dtype.itemsize)
+        header = json.dumps({
+            'hash_size': self.hash_size,
+            'count': self.count,
+            'words': self.words,
+            'algorithms': list(self.algorithms),
+            'orientations': self.orientations,
+            'quality_fields': list(QUALITY_FIELDS),
+            'columns': columns,
+            'strings': {'offset': offset, 'size': self.string_size},
+        }).encode('utf-8')
+
+        data_start = _align(HASH_DB_PREAMBLE.size + len(header))
+        with open(self.db_path, 'wb') as f:
+            f.write(HASH_DB_PREAMBLE.pack(HASH_DB_MAGIC, HASH_DB_VERSION, len(header)))
+            f.write(header)
+            for name, section_offset in [(name, columns[name]['offset']) for name in self.names] + [('strings', offset)]:
+                spill_path = os.path.join(self.spill_dir, name)
+                if not os.path.exists(spill_path): continue
+                f.seek(data_start + section_offset)
+                with open(spill_path, 'rb') as spill:
+                    shutil.copyfileobj(spill, f)
+            f.truncate(data_start + offset + self.string_size)
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return self.db_path
+
+def write_hash_db(db_path, hash_size, hashes, variants=None, algorithms=DEFAULT_HASH_ALGORITHMS, quality=None):
+    """把 {路径: 哈希元组} 写成二进制哈希库，元组顺序与 algorithms 一致。variants 给出每张图片 8 个方向的哈希时一并写入，
+    quality 给出画质特征时写入 quality 列。"""
+    writer = HashDbWriter(db_path, hash_size, len(ORIENTATIONS) if variants else 1, algorithms=algorithms)
+    for path in sorted(hashes):
+        writer.add(path, variants[path] if variants else [hashes[path]], quality.get(path) if quality else None)
+    return writer.close()
+
+class HashDatabase:
+    """只读打开二进制哈希库。各列都是 numpy.memmap，打开时不解析数据，多个进程共享同一份页缓存。"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with open(db_path, 'rb') as f:
+            magic, version, header_len = HASH_DB_PREAMBLE.unpack(f.read(HASH_DB_PREAMBLE.size))
+            if magic != HASH_DB_MAGIC:
+                raise ValueError(f"不是哈希库文件: {db_path}")
+            if version != HASH_DB_VERSION:
+                raise ValueError(f"不支持的哈希库版本 {version}: {db_path}")
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.data_start = _align(HASH_DB_PREAMBLE.size + header_len)
+        self.hash_size = self.header['hash_size']
+        self.count = self.header['count']
+        self.words = self.header['words']
+        self.algorithms = tuple(self.header.get('algorithms', DEFAULT_HASH_ALGORITHMS))
+        self.orientations = self.header.get('orientations', 1)
+        self._columns = {}
+        self._string_offsets = self.column('string_offsets')
+        strings = self.header['strings']
+        self._string_data = numpy.memmap(db_path, dtype=numpy.uint8, mode='r',
+                                         offset=self.data_start + strings['offset'],
+                                         shape=(strings['size'],)) if strings['size'] else b''
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        if name not in self._columns:
+            spec = self.header['columns'][name]
+            if 0 in spec['shape']:
+                self._columns[name] = numpy.zeros(spec['shape'], dtype=spec['dtype'])
+            else:
+                self._columns[name] = numpy.memmap(self.db_path, dtype=spec['dtype'], mode='r',
+                                                   offset=self.data_start + spec['offset'],
+                                                   shape=tuple(spec['shape']))
+        return self._columns[name]
+
+    def path(self, index):
+        start, end = int(self._string_offsets[index]), int(self._string_offsets[index + 1])
+        return bytes(self._string_data[start:end]).decode('utf-8')
+
+    @property
+    def paths(self):
+        return [self.path(i) for i in range(self.count)]
+
+    def hash_tuple(self, index):
+        return self.hash_variants(index)[0]
+
+    def hash_variants(self, index):
+        if not self.column('valid')[index]:
+            return [(None,) * len(self.algorithms)]
+        return [tuple(words_to_hash(self.column(orientation_column(name, k))[index], self.hash_size,
+                                    HASH_ALGORITHMS[name].shape(self.hash_size))
+                      for name in self.algorithms) for k in range(self.orientations)]
+
+    def to_hashes(self):
+        return {self.path(i): self.hash_tuple(i) for i in range(self.count)}
+
+    def quality(self, index):
+        """返回第 index 张图片的画质特征字典；旧版哈希库没有 quality 列或该图片计算失败时返回 None"""
+        if 'quality' not in self.header['columns']:
+            return None
+        row = self.column('quality')[index]
+        if numpy.isnan(row).any():
+            return None
+        return {field: float(value) for field, value in zip(self.header['quality_fields'], row)}
+
+    def quality_for(self, paths):
+        """读出 paths 中各图片的画质特征，返回 {路径: 特征字典}"""
+        wanted = set(paths)
+        if 'quality' not in self.header['columns'] or not wanted:
+            return {}
+        return {path: record for path, record in ((self.path(i), self.quality(i)) for i in range(self.count))
+                if path in wanted and record}
+
+def db_scoring_plan(algorithms, hash_size):
+    """返回 (phash 所在位置或 None, [(位置, 权重, 位数), ...] 按评分顺序, 总权重)"""
+    order, total_weight = scoring_plan(tuple(algorithms))
+    steps = [(index, HASH_ALGORITHMS[algorithms[index]].weight, HASH_ALGORITHMS[algorithms[index]].max_bits(hash_size))
+             for index in order]
+    phash_index = algorithms.index('phash') if 'phash' in algorithms else None
+    return phash_index, steps, total_weight
+
+def _similar_mask(row, block, threshold, max_phash_dist, plan):
+    """row 为一张图片各算法的哈希行，block 为一组图片的对应列，返回 block 中相似的行。
+
+    与 is_similar_pair 相同：先做 phash 预检，再按开销顺序累加，每一步都剔除已不可能达到阈值的行，
+    后面的列只读取剩下的行。
+    """
+    phash_index, steps, total_weight = plan
+    mask = numpy.zeros(len(block[0]), dtype=bool)
+    candidates = numpy.arange(len(block[0]))
+    distances = {}
+    if phash_index is not None:
+        phash_dist = popcount64(block[phash_index] ^ row[phash_index])
+        candidates = numpy.flatnonzero(phash_dist <= max_phash_dist)
+        distances[phash_index] = phash_dist[candidates]
+
+    combined_sim, remaining_weight = numpy.zeros(len(candidates)), total_weight
+    for index, weight, max_bits in steps:
+        if not len(candidates): return mask
+        distance = distances.pop(index, None)
+        if distance is None:
+            distance = popcount64(block[index][candidates] ^ row[index])
+        combined_sim = combined_sim + (1 - distance / max_bits) * 100 * weight
+        remaining_weight -= weight
+        keep = combined_sim + remaining_weight * 100 >= threshold * total_weight - SCORE_EPSILON
+        if not keep.all():
+            candidates, combined_sim = candidates[keep], combined_sim[keep]
+            distances = {key: value[keep] for key, value in distances.items()}
+    mask[candidates[combined_sim / total_weight >= threshold]] = True
+    return mask
+
+def find_similar_pairs_in_db(db, threshold, progress=None, pairs=None, block_rows=None):
+    """直接在哈希库的 uint64 列上向量化比较，判定规则与 matches_any_orientation 完全一致，返回下标对。
+
+    pairs 可以传入 PairSpill 等带 extend 的容器；block_rows 限制每次读入内存的行数。
+    """
+    max_phash_dist = get_max_phash_dist(db.hash_size, threshold)
+    plan = db_scoring_plan(db.algorithms, db.hash_size)
+    columns = [tuple(db.column(orientation_column(name, k)) for name in db.algorithms) for k in range(db.orientations)]
+    valid = numpy.flatnonzero(db.column('valid'))
+
+    pairs = [] if pairs is None else pairs
+    for k, i in enumerate(valid[:-1]):
+        identity_row = tuple(column[i] for column in columns[0])
+        oriented_rows = [tuple(column[i] for column in oriented) for oriented in columns[1:]]
+        remaining = valid[k + 1:]
+        for start in range(0, len(remaining), block_rows or len(remaining)):
+            rest = remaining[start:start + block_rows] if block_rows else remaining
+            identity_block = tuple(column[rest] for column in columns[0])
+            matched = _similar_mask(identity_row, identity_block, threshold, max_phash_dist, plan)
+            for oriented, oriented_row in zip(columns[1:], oriented_rows):
+                matched |= _similar_mask(identity_row, tuple(column[rest] for column in oriented),
+                                         threshold, max_phash_dist, plan)
+                matched |= _similar_mask(oriented_row, identity_block, threshold, max_phash_dist, plan)
+            pairs.extend((int(i), int(j)) for j in rest[matched])
+        if progress:
+            progress(k + 1, len(valid))
+    return pairs
+
+# ==============================================================================
+#  内存受限扫描：按预算缓冲，超出时把哈希列和候选对溢出到磁盘上的 memmap 文件
+# ==============================================================================
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_memory_size(text):
+    """把 '512M'、'2G'、'1048576' 之类的字符串解析为字节数"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无法解析内存大小: {text}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+class MemoryBudget:
+    """统计引擎自身缓冲区占用的字节数。reserve 超出上限时返回 False，由调用方先溢出到磁盘。"""
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.used = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self.lock:
+            if self.used + nbytes > self.max_memory:
+                return False
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, nbytes):
+        with self.lock:
+            self.used = max(0, self.used - nbytes)
+
+    @property
+    def available(self):
+        return max(0, self.max_memory - self.used)
+
+class PairSpill:
+    """候选对的追加缓冲区：预算内留在内存，超出时追加写到 int64 (N, 2) 文件，读取时按块 memmap。"""
+    PAIR_BYTES = 16
+
+    def __init__(self, spill_path, budget=None):
+        self.spill_path = spill_path
+        self.budget = budget
+        self._buffer = []
+        self._spilled = 0
+
+    def __len__(self):
+        return self._spilled + len(self._buffer)
+
+    def extend(self, pairs):
+        for pair in pairs:
+            if self.budget and not self.budget.reserve(self.PAIR_BYTES):
+                self.flush()
+                self.budget.reserve(self.PAIR_BYTES)
+            self._buffer.append(pair)
+
+    def flush(self):
+        if not self._buffer: return
+        with open(self.spill_path, 'ab') as f:
+            f.write(numpy.array(self._buffer, dtype='<i8').tobytes())
+        self._spilled += len(self._buffer)
+        if self.budget:
+            self.budget.release(len(self._buffer) * self.PAIR_BYTES)
+        self._buffer.clear()
+
+    def chunks(self, chunk_rows=65536):
+        """依次返回 (n, 2) 的候选对数组，先读磁盘上的部分，再读内存中的部分"""
+        if self._spilled:
+            spilled = numpy.memmap(self.spill_path, dtype='<i8', mode='r', shape=(self._spilled, 2))
+            for start in range(0, self._spilled, chunk_rows):
+                yield numpy.array(spilled[start:start + chunk_rows])
+            del spilled
+        if self._buffer:
+            yield numpy.array(self._buffer, dtype='<i8').reshape(-1, 2)
+
+    def close(self):
+        if self.budget:
+            self.budget.release(len(self._buffer) * self.PAIR_BYTES)
+        self._buffer.clear()
+
+def _budgeted_array(count, dtype, budget, spill_path):
+    """预算允许时在内存中分配数组，否则创建同样形状的 memmap 临时文件"""
+    nbytes = count * numpy.dtype(dtype).itemsize
+    if budget is None or budget.reserve(nbytes):
+        return numpy.zeros(count, dtype=dtype), nbytes
+    return numpy.memmap(spill_path, dtype=dtype, mode='w+', shape=(max(count, 1),)), 0
+
+def external_union_find(pair_chunks, count, budget=None, work_dir=None, chunk_rows=65536):
+    """对 0..count-1 的节点按候选对做并查集，父节点数组超出预算时放在 memmap 文件中，返回下标组成的组"""
+    work_dir = work_dir or tempfile.gettempdir()
+    parent, parent_bytes = _budgeted_array(count, numpy.int64, budget, os.path.join(work_dir, 'parent.i64'))
+    linked, linked_bytes = _budgeted_array(count, numpy.uint8, budget, os.path.join(work_dir, 'linked.u8'))
+    for start in range(0, count, chunk_rows):
+        parent[start:start + chunk_rows] = numpy.arange(start, min(start + chunk_rows, count))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]  # 路径减半
+            node = int(parent[node])
+        return node
+
+    for chunk in pair_chunks:
+        linked[chunk.ravel()] = 1
+        for a, b in chunk.tolist():
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = {}
+    for start in range(0, count, chunk_rows):
+        for node in (numpy.flatnonzero(linked[start:start + chunk_rows]) + start).tolist():
+            groups.setdefault(find(node), []).append(node)
+    if budget:
+        budget.release(parent_bytes + linked_bytes)
+    del parent, linked
+    return [group for group in groups.values() if len(group) > 1]
+
+def cluster_pairs(pair_chunks, count, mode='leader', tiebreak=None, budget=None, work_dir=None):
+    """在候选对构成的邻接图上做限制直径的聚类，返回下标组成的组。
+
+    pair_chunks() 每次调用都重新产出一遍 (k, 2) 下标对数组，自身配对会被忽略，同一对不应重复出现
+    （cluster_similar_pairs 会先去重）。按邻居数从多到少依次取尚未分组的节点作为中心：
+    leader 模式把中心尚未分组的邻居全部并入，组内任意两张最多隔着中心两步；
+    complete 模式只并入与组内已有成员全部相似的邻居，组内两两相似。
+    tiebreak 为每个节点的 uint32 排序键，邻居数相同时按它排序，使结果与下标顺序无关。
+    邻接表按 CSR 存放，超出预算时放在 memmap 文件中，总耗时约为 O(节点数 × 邻居数)。
+    """
+    work_dir = work_dir or tempfile.gettempdir()
+    reserved = []
+
+    def allocate(name, size, dtype):
+        array, nbytes = _budgeted_array(size, dtype, budget, os.path.join(work_dir, name))
+        reserved.append(nbytes)
+        return array
+
+    def distinct_chunks():
+        for chunk in pair_chunks():
+            yield chunk[chunk[:, 0] != chunk[:, 1]]
+
+    degree = allocate('degree.i64', count, numpy.int64)
+    for chunk in distinct_chunks():
+        numpy.add.at(degree, chunk.ravel(), 1)
+    offsets = allocate('offsets.i64', count + 1, numpy.int64)
+    numpy.cumsum(degree, out=offsets[1:])
+    neighbours = allocate('neighbours.i64', int(offsets[count]), numpy.int64)
+    cursor = allocate('cursor.i64', count, numpy.int64)
+    cursor[:] = offsets[:-1]
+    for chunk in distinct_chunks():
+        # 每个对在两个端点的邻接表中各写一次，同一节点的多个邻居按出现顺序依次排在 cursor 之后
+        nodes = numpy.concatenate([chunk[:, 0], chunk[:, 1]])
+        others = numpy.concatenate([chunk[:, 1], chunk[:, 0]])
+        order = numpy.argsort(nodes, kind='stable')
+        nodes, others = nodes[order], others[order]
+        starts = numpy.flatnonzero(numpy.r_[True, nodes[1:] != nodes[:-1]])
+        rank = numpy.arange(len(nodes)) - numpy.repeat(starts, numpy.diff(numpy.r_[starts, len(nodes)]))
+        neighbours[cursor[nodes] + rank] = others
+        numpy.add.at(cursor, nodes, 1)
+
+    linked = numpy.flatnonzero(degree)
+    tiebreak = tiebreak if tiebreak is not None else numpy.arange(count)
+
+    def by_priority(nodes):
+        return nodes[numpy.lexsort((tiebreak[nodes], -degree[nodes]))]
+
+    assigned = allocate('assigned.u8', count, numpy.uint8)
+    in_group = allocate('in_group.u8', count, numpy.uint8)
+    groups = []
+    for leader in by_priority(linked).tolist():
+        if assigned[leader]: continue
+        candidates = neighbours[offsets[leader]:offsets[leader + 1]]
+        candidates = by_priority(candidates[assigned[candidates] == 0])
+        if mode == 'complete':
+            members = [leader]
+            in_group[leader] = 1
+            for node in candidates.tolist():
+                if numpy.count_nonzero(in_group[neighbours[offsets[node]:offsets[node + 1]]]) == len(members):
+                    members.append(node)
+                    in_group[node] = 1
+            in_group[members] = 0
+        else:
+            members = [leader] + candidates.tolist()
+        # 邻居都已分到别的组时中心保持未分组，之后仍可被其他中心并入
+        if len(members) > 1:
+            assigned[members] = 1
+            groups.append(members)
+    if budget:
+        budget.release(sum(reserved))
+    del degree, offsets, neighbours, cursor, assigned, in_group
+    return groups
+
+def path_tiebreak(path):
+    return zlib.crc32(path.encode('utf-8'))
+
+def cluster_similar_pairs(similar_pairs, mode='leader'):
+    """对路径对做 cluster_pairs，返回路径组成的组。自身配对和重复的对（包括顺序相反的）先去掉。"""
+    similar_pairs = {(a, b) if a < b else (b, a) for a, b in similar_pairs if a != b}
+    paths = sorted({path for pair in similar_pairs for path in pair})
+    index = {path: i for i, path in enumerate(paths)}
+    pairs = numpy.array(sorted((index[a], index[b]) for a, b in similar_pairs), dtype=numpy.int64).reshape(-1, 2)
+    tiebreak = numpy.array([path_tiebreak(path) for path in paths], dtype=numpy.uint32)
+    groups = cluster_pairs(lambda: [pairs], len(paths), mode, tiebreak)
+    return [[paths[i] for i in group] for group in groups]
+
+def group_pairs(similar_pairs, clustering=DEFAULT_CLUSTERING):
+    """按 clustering 指定的方式把相似路径对合并成组"""
+    if clustering == 'connected':
+        return union_find_groups(similar_pairs)
+    return cluster_similar_pairs(similar_pairs, clustering)
+
+def find_groups_in_db(db, threshold, budget, work_dir, progress=None, clustering=DEFAULT_CLUSTERING):
+    """在哈希库上比较并分组，候选对和并查集（或聚类的邻接表）都受内存预算约束，返回路径组成的组"""
+    row_bytes = sum(hash_words(db.hash_size, name) for name in db.algorithms) * db.orientations * 8 + 64
+    block_rows = max(1024, budget.available // 4 // row_bytes) if budget else None
+    pairs = PairSpill(os.path.join(work_dir, 'pairs.i64'), budget)
+    find_similar_pairs_in_db(db, threshold, progress, pairs, block_rows)
+    if clustering == 'connected':
+        groups = external_union_find(pairs.chunks(), len(db), budget, work_dir)
+    else:
+        tiebreak, tiebreak_bytes = _budgeted_array(len(db), numpy.uint32, budget, os.path.join(work_dir, 'tiebreak.u32'))
+        for i in range(len(db)):
+            tiebreak[i] = path_tiebreak(db.path(i))
+        groups = cluster_pairs(pairs.chunks, len(db), clustering, tiebreak, budget, work_dir)
+        if budget:
+            budget.release(tiebreak_bytes)
+        del tiebreak
+    pairs.close()
+    return [[db.path(i) for i in group] for group in groups]
+
+def iter_source_variants(sources, hash_size, orientations=False, max_workers=None, algorithms=DEFAULT_HASH_ALGORITHMS,
+                         quality=None):
+    """并行计算哈希，按完成顺序逐个返回 calculate_source_variants 的结果；只保留有限个进行中的任务"""
+    max_workers = max_workers or os.cpu_count() or 4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending, source_iter = set(), iter(sources)
+        try:
+            while True:
+                for source in itertools.islice(source_iter, max_workers * 4 - len(pending)):
+                    pending.add(executor.submit(calculate_source_variants, source, hash_size, orientations, algorithms,
+                                                quality))
+                if not pending: break
+                future = next(as_completed(pending))
+                pending.discard(future)
+                yield future.result()
+        finally:
+            for future in pending: future.cancel()
+
+def run_budgeted_scan(folder_paths, threshold, hash_size, max_memory, work_dir, max_workers=None,
+                      orientations=False, progress=None, should_stop=None, algorithms=DEFAULT_HASH_ALGORITHMS,
+                      walk_options=None, quality=None, clustering=DEFAULT_CLUSTERING):
+    """在 max_memory 字节的预算内扫描文件夹：哈希边算边写入临时哈希库，再用 find_groups_in_db 分组。
+
+    progress(percent, status) 报告进度；should_stop() 返回 True 时中止并返回 None。
+    画质特征随哈希写入临时哈希库，传入 quality 字典时只读回分到组里的图片。
+    """
+    progress = progress or (lambda percent, status: None)
+    budget = MemoryBudget(max_memory)
+    sources = collect_image_sources(folder_paths, **(walk_options or {}))
+    if not sources:
+        return []
+
+    progress(0, f"阶段 1/3: 正在并行计算 {len(sources)} 个文件的哈希值（内存上限 {max_memory // 1024 ** 2} MB）...")
+    db_path = os.path.join(work_dir, 'scan.simdb')
+    writer = HashDbWriter(db_path, hash_size, len(ORIENTATIONS) if orientations else 1, budget, algorithms)
+    pending_quality = {}
+    for done, items in enumerate(iter_source_variants(sources, hash_size, orientations, max_workers, algorithms,
+                                                      pending_quality), 1):
+        for path, hash_variants in items:
+            writer.add(path, hash_variants, pending_quality.pop(path, None))
+        progress(int(done / len(sources) * 40), f"计算哈希: {done}/{len(sources)}")
+        if should_stop and should_stop():
+            writer.close()
+            return None
+    writer.close()
+
+    db = HashDatabase(db_path)
+    if len(db) < 2:
+        return []
+
+    def report(done, total):
+        if done % 50 == 0 or done == total:
+            progress(40 + int(done / total * 50), f"阶段 2/3: 比较中... ({done}/{total})")
+        if should_stop and should_stop():
+            raise InterruptedError
+
+    progress(40, "阶段 2/3: 正在比较图片相似度...")
+    try:
+        groups = find_groups_in_db(db, threshold, budget, work_dir, report, clustering)
+    except InterruptedError:
+        return None
+    if quality is not None:
+        quality.update(db.quality_for(path for group in groups for path in group))
+    progress(90, f"阶段 3/3: 合并完成，内存峰值约 {budget.peak // 1024 ** 2} MB")
+    return groups
 
 # ==============================================================================
 #  *** 核心修改：性能优化的多线程 Worker ***
@@ -114,46 +1502,73 @@ class Worker(QThread):
     progress = pyqtSignal(int, str)
     finished = pyqtSignal(list)
 
-    def __init__(self, folder_paths, threshold, hash_size):
+    def __init__(self, folder_paths, threshold, hash_size, num_processes=1, hash_db_path=None, orientations=False,
+                 max_memory=0, algorithms=DEFAULT_HASH_ALGORITHMS, walk_options=None, clustering=DEFAULT_CLUSTERING):
         super().__init__()
         self.folder_paths = folder_paths
         self.threshold = threshold
         self.hash_size = hash_size
+        self.num_processes = num_processes
+        self.hash_db_path = hash_db_path
+        self.orientations = orientations
+        self.max_memory = max_memory  # 字节，0 表示不限制
+        self.algorithms = tuple(algorithms)
+        self.walk_options = walk_options or {}  # collect_image_sources 的遍历参数
+        self.clustering = clustering  # CLUSTERING_MODES 中的一种
+        self.hashes = {}
+        self.variants = {}
+        self.quality = {}  # 画质目录 {路径: 特征字典}，用于挑选每组最佳图片
         self.is_running = True
         self.max_workers = os.cpu_count() or 4
 
     def run(self):
-        # --- 阶段1: 收集图片路径 ---
-        image_paths = []
-        for folder_path in self.folder_paths:
-            for root, _, files in os.walk(folder_path):
-                for file in files:
-                    if allowed_file(file):
-                        image_paths.append(os.path.join(root, file))
+        if self.hash_db_path:
+            self.run_from_db()
+            return
+        if self.max_memory:
+            self.run_budgeted()
+            return
+        if self.num_processes > 1:
+            self.run_sharded()
+            return
+
+        # --- 阶段1: 收集图片路径（包括压缩包） ---
+        sources = collect_image_sources(self.folder_paths, **self.walk_options)
         
-        total_images = len(image_paths)
-        if total_images < 2:
+        total_sources = len(sources)
+        if total_sources == 0:
             self.finished.emit([])
             return
 
         # --- 阶段2: 并行计算哈希值 ---
-        self.progress.emit(0, f"阶段 1/3: 正在并行计算 {total_images} 张图片的哈希值...")
-        hashes = {}
+        self.progress.emit(0, f"阶段 1/3: 正在并行计算 {total_sources} 个文件的哈希值...")
+        hashes, variants = self.hashes, self.variants
+        source_results = {}
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = [executor.submit(calculate_hashes_for_image, path, self.hash_size) for path in image_paths]
+            futures = {executor.submit(calculate_source_variants, source, self.hash_size, self.orientations,
+                                       self.algorithms, self.quality): source
+                       for source in sources}
             for i, future in enumerate(as_completed(futures)):
                 if not self.is_running: return
-                path, hash_tuple = future.result()
-                hashes[path] = hash_tuple
-                self.progress.emit(int((i + 1) / total_images * 40), f"计算哈希: {os.path.basename(path)}")
+                source = futures[future]
+                source_results[source] = future.result()
+                for path, hash_variants in source_results[source]:
+                    hashes[path] = hash_variants[0]
+                    variants[path] = hash_variants
+                self.progress.emit(int((i + 1) / total_sources * 40), f"计算哈希: {os.path.basename(source)}")
+
+        image_paths = [path for source in sources for path, _ in source_results[source]]
+        total_images = len(image_paths)
+        if total_images < 2:
+            self.finished.emit([])
+            return
 
         # --- 阶段3: 优化后的相似度比较 ---
         self.progress.emit(40, "阶段 2/3: 正在比较图片相似度...")
         similar_pairs = []
         
         # *** 性能优化：预先计算最大允许的哈希距离 ***
-        # 只有当两张图片的phash距离小于这个值时，我们才进行完整的比较
-        max_phash_dist = int((self.hash_size**2) * (1 - (self.threshold - 10) / 100))
+        max_phash_dist = get_max_phash_dist(self.hash_size, self.threshold)
 
         total_comparisons = total_images * (total_images - 1) // 2
         completed_comparisons = 0
@@ -162,8 +1577,8 @@ class Worker(QThread):
         for i in range(total_images):
             if not self.is_running: return
             path1 = image_paths[i]
-            phash1, ahash1, dhash1 = hashes.get(path1, (None, None, None))
-            if not phash1: continue
+            variants1 = variants.get(path1, [(None,)])
+            if not variants1[0][0]: continue
 
             for j in range(i + 1, total_images):
                 completed_comparisons += 1
@@ -171,20 +1586,8 @@ class Worker(QThread):
                     self.progress.emit(40 + int(completed_comparisons / total_comparisons * 50), f"阶段 2/3: 比较中... ({completed_comparisons}/{total_comparisons})")
 
                 path2 = image_paths[j]
-                phash2, ahash2, dhash2 = hashes.get(path2, (None, None, None))
-                if not phash2: continue
-
-                # *** 性能优化：快速预检 ***
-                if (phash1 - phash2) > max_phash_dist:
-                    continue
-
-                # 只有通过了快速预检的图片对，才进行完整计算
-                phash_sim = calculate_similarity(phash1, phash2)
-                ahash_sim = calculate_similarity(ahash1, ahash2)
-                dhash_sim = calculate_similarity(dhash1, dhash2)
-                combined_sim = (phash_sim * 0.5 + ahash_sim * 0.3 + dhash_sim * 0.2)
-                
-                if combined_sim >= self.threshold:
+                variants2 = variants.get(path2, [(None,)])
+                if matches_any_orientation(variants1, variants2, self.threshold, max_phash_dist, self.algorithms):
                     similar_pairs.append((path1, path2))
 
         # --- 阶段4: 合并相似对为组 ---
@@ -194,7 +1597,62 @@ class Worker(QThread):
         self.progress.emit(100, "处理完成！")
         self.finished.emit(similarity_groups)
 
+    def run_from_db(self):
+        # --- 从二进制哈希库读取，跳过遍历文件夹和计算哈希 ---
+        self.progress.emit(0, "正在打开哈希库...")
+        db = HashDatabase(self.hash_db_path)
+        self.hash_size = db.hash_size
+        self.algorithms = db.algorithms
+
+        def report(done, total):
+            if done % 50 == 0 or done == total:
+                self.progress.emit(int(done / total * 90), f"阶段 2/3: 比较中... ({done}/{total})")
+            if not self.is_running:
+                raise InterruptedError
+
+        self.progress.emit(0, f"阶段 2/3: 正在比较哈希库中的 {len(db)} 张图片...")
+        try:
+            if self.max_memory:
+                with tempfile.TemporaryDirectory(prefix='similarity-spill-') as work_dir:
+                    similarity_groups = find_groups_in_db(db, self.threshold, MemoryBudget(self.max_memory),
+                                                          work_dir, report, self.clustering)
+            else:
+                index_pairs = find_similar_pairs_in_db(db, self.threshold, report)
+                self.progress.emit(90, "阶段 3/3: 正在合并相似组...")
+                similarity_groups = self.group_similar_pairs((db.path(i), db.path(j)) for i, j in index_pairs)
+        except InterruptedError:
+            return
+
+        self.quality = db.quality_for(path for group in similarity_groups for path in group)
+        self.progress.emit(100, "处理完成！")
+        self.finished.emit(similarity_groups)
+
+    def run_sharded(self):
+        # --- 多进程分片扫描: 每个进程负责一个分片，最后合并 ---
+        with tempfile.TemporaryDirectory(prefix='similarity-shards-') as work_dir:
+            similarity_groups = run_sharded_scan(self.folder_paths, self.threshold, self.hash_size,
+                                                 self.num_processes, work_dir, orientations=self.orientations,
+                                                 algorithms=self.algorithms, walk_options=self.walk_options,
+                                                 quality=self.quality, clustering=self.clustering,
+                                                 progress=self.progress.emit, should_stop=lambda: not self.is_running)
+        if similarity_groups is None or not self.is_running: return
+        self.progress.emit(100, "处理完成！")
+        self.finished.emit(similarity_groups)
+
+    def run_budgeted(self):
+        # --- 内存受限扫描: 哈希和候选对超出预算时溢出到临时文件，不保留 self.hashes ---
+        with tempfile.TemporaryDirectory(prefix='similarity-spill-') as work_dir:
+            similarity_groups = run_budgeted_scan(self.folder_paths, self.threshold, self.hash_size, self.max_memory,
+                                                  work_dir, self.max_workers, self.orientations,
+                                                  self.progress.emit, lambda: not self.is_running, self.algorithms,
+                                                  self.walk_options, self.quality, self.clustering)
+        if similarity_groups is None or not self.is_running: return
+        self.progress.emit(100, "处理完成！")
+        self.finished.emit(similarity_groups)
+
     def group_similar_pairs(self, similar_pairs):
+        if self.clustering != 'connected':
+            return cluster_similar_pairs(similar_pairs, self.clustering)
         graph = {}
         for p1, p2 in similar_pairs:
             graph.setdefault(p1, set()).add(p2)
@@ -219,6 +1677,230 @@ class Worker(QThread):
     def stop(self):
         self.is_running = False
 
+# ==============================================================================
+#  批量去重操作：分批并行执行删除/隔离/硬链接替换，追加写日志，支持撤销和崩溃恢复
+# ==============================================================================
+ACTION_DELETE = 'delete'
+ACTION_QUARANTINE = 'quarantine'
+ACTION_HARDLINK = 'hardlink'
+ACTION_REFLINK = 'reflink'
+LINK_ACTIONS = (ACTION_HARDLINK, ACTION_REFLINK)
+ACTIONS = (ACTION_DELETE, ACTION_QUARANTINE) + LINK_ACTIONS
+REFLINK_SUPPORTED = sys.platform.startswith('linux')
+QUARANTINE_DIRNAME = '.similarity-quarantine'
+FICLONE = 0x40049409  # Linux ioctl，Btrfs/XFS 等文件系统上的写时复制克隆
+
+def reflink_file(src, dst):
+    """不支持 reflink 的系统或文件系统上抛出 OSError(EOPNOTSUPP)"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "当前系统不支持 reflink")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError as e:
+            raise OSError(errno.EOPNOTSUPP, f"reflink 失败: {e.strerror or e}") from e
+
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.move(src, dst)
+
+class BulkActionEngine:
+    """执行批量去重计划。
+
+    每一批先把 begin 记录写入日志并落盘，再并行操作文件，成功的写 commit 记录。
+    隔离和链接替换会把原文件移动到同目录下的隔离区（同一文件系统内只是改名），
+    因此可以撤销；中途崩溃时 recover() 会回滚只有 begin 没有 commit 的操作。
+    """
+
+    def __init__(self, state_dir, max_workers=None, batch_size=256):
+        self.journal_dir = os.path.join(state_dir, 'journal')
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 4) * 4)
+        self.batch_size = batch_size
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+    def execute(self, plan, progress=None):
+        """plan 为 [(操作, 路径, 保留的图片)]，返回 (日志路径, 成功的条目, 失败的条目)。操作不在 ACTIONS 中时抛出 ValueError。"""
+        for action, _, _ in plan:
+            if action not in ACTIONS:
+                raise ValueError(f"未知的操作: {action}")
+        session = time.strftime('%Y%m%d-%H%M%S') + f"-{uuid.uuid4().hex[:8]}"
+        journal_path = os.path.join(self.journal_dir, f"{session}.jsonl")
+        entries = []
+        for seq, (action, path, keeper) in enumerate(plan):
+            backup = None
+            if action != ACTION_DELETE:
+                backup = os.path.join(os.path.dirname(path), QUARANTINE_DIRNAME, session,
+                                      f"{seq:08d}_{os.path.basename(path)}")
+            entries.append({'seq': seq, 'action': action, 'path': path, 'keeper': keeper, 'backup': backup})
+
+        completed, failed = [], []
+        with open(journal_path, 'a', encoding='utf-8') as journal, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for start in range(0, len(entries), self.batch_size):
+                batch = entries[start:start + self.batch_size]
+                self._append(journal, [dict(entry, event='begin') for entry in batch])
+                results = list(executor.map(self._apply, batch))
+                self._append(journal, [{'event': 'commit', 'seq': entry['seq']}
+                                       for entry, error in zip(batch, results) if error is None])
+                for entry, error in zip(batch, results):
+                    if error is None:
+                        completed.append(entry)
+                    else:
+                        failed.append(dict(entry, error=error))
+                if progress:
+                    progress(min(start + self.batch_size, len(entries)), len(entries))
+        return journal_path, completed, failed
+
+    def _append(self, journal, records):
+        if not records: return
+        journal.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _apply(self, entry):
+        action, path, keeper, backup = entry['action'], entry['path'], entry['keeper'], entry['backup']
+        try:
+            if action == ACTION_DELETE:
+                os.remove(path)
+                return None
+            os.makedirs(os.path.dirname(backup), exist_ok=True)
+            if action == ACTION_QUARANTINE:
+                move_file(path, backup)
+                return None
+
+            # 先在临时名上建立链接，成功后再把原文件移入隔离区并原子替换
+            temp_path = f"{path}.simlink-tmp"
+            try:
+                if action == ACTION_HARDLINK:
+                    os.link(keeper, temp_path)
+                else:
+                    reflink_file(keeper, temp_path)
+                move_file(path, backup)
+                try:
+                    os.replace(temp_path, path)
+                except OSError:
+                    move_file(backup, path)  # 原文件已在隔离区，替换失败时立即放回，不等到撤销
+                    raise
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            return None
+        except Exception as e:  # 单个条目出错只记为失败，不中断整批操作
+            return str(e)
+
+    def read_journal(self, journal_path):
+        entries, finished = {}, {}
+        with open(journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 崩溃时最后一行可能不完整
+                if record['event'] == 'begin':
+                    entries[record['seq']] = record
+                else:
+                    finished.setdefault(record['seq'], set()).add(record['event'])
+        return entries, finished
+
+    def _restore(self, entry):
+        backup, path = entry['backup'], entry['path']
+        if backup and os.path.exists(backup):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            move_file(backup, path)  # 链接替换时会覆盖链接，恢复原文件
+            return True
+        return False
+
+    def undo(self, journal_path):
+        """撤销一次操作，返回 (已恢复的条目, 无法恢复的条目)。删除操作无法撤销。"""
+        entries, finished = self.read_journal(journal_path)
+        restored, unrecoverable, records = [], [], []
+        for seq in sorted(entries, reverse=True):
+            events = finished.get(seq, set())
+            if 'commit' not in events or events & {'undo', 'purge'}:
+                continue
+            entry = entries[seq]
+            try:
+                if self._restore(entry):
+                    restored.append(entry)
+                    records.append({'event': 'undo', 'seq': seq})
+                else:
+                    unrecoverable.append(entry)
+            except OSError:
+                unrecoverable.append(entry)
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            self._append(journal, records)
+        return restored, unrecoverable
+
+    def recover(self):
+        """回滚所有日志中未完成（只有 begin）的操作，返回回滚的条目数。"""
+        rolled_back = 0
+        for journal_path in self.journals():
+            entries, finished = self.read_journal(journal_path)
+            records = []
+            for seq, entry in entries.items():
+                if seq in finished:
+                    continue
+                temp_path = f"{entry['path']}.simlink-tmp"
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                # 链接替换可能已经覆盖了原路径，隔离只在原路径不存在时恢复
+                if entry['action'] in LINK_ACTIONS or not os.path.exists(entry['path']):
+                    try:
+                        self._restore(entry)
+                    except OSError:
+                        pass
+                records.append({'event': 'rollback', 'seq': seq})
+            if records:
+                with open(journal_path, 'a', encoding='utf-8') as journal:
+                    self._append(journal, records)
+                rolled_back += len(records)
+        return rolled_back
+
+    def purge(self, journal_path):
+        """清空一次操作的隔离区，真正释放磁盘空间，之后无法撤销。"""
+        entries, finished = self.read_journal(journal_path)
+        records = []
+        for seq, entry in entries.items():
+            events = finished.get(seq, set())
+            if 'commit' in events and not events & {'undo', 'purge'} and entry['backup']:
+                try:
+                    os.remove(entry['backup'])
+                except FileNotFoundError:
+                    pass
+                records.append({'event': 'purge', 'seq': seq})
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            self._append(journal, records)
+        return len(records)
+
+    def journals(self):
+        return sorted(os.path.join(self.journal_dir, name) for name in os.listdir(self.journal_dir)
+                      if name.endswith('.jsonl'))
+
+class ActionWorker(QThread):
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(str, list, list)
+
+    def __init__(self, engine, plan):
+        super().__init__()
+        self.engine = engine
+        self.plan = plan
+
+    def run(self):
+        def report(done, total):
+            self.progress.emit(int(done / total * 100), f"正在执行批量操作... ({done}/{total})")
+        try:
+            journal_path, completed, failed = self.engine.execute(self.plan, report)
+        except Exception as e:
+            # 保证界面总能收到 finished，按钮不会一直处于禁用状态
+            journal_path, completed = '', []
+            failed = [{'action': action, 'path': path, 'keeper': keeper, 'backup': None, 'error': str(e)}
+                      for action, path, keeper in self.plan]
+        self.finished.emit(journal_path, completed, failed)
+
 # ==============================================================================
 #  自定义图片控件 (无变化)
 # ==============================================================================
@@ -237,12 +1919,16 @@ class ImageWidget(QWidget):
         self.img_label.setFixedSize(200, 200)
         
         try:
-            pixmap = QPixmap(img_path)
+            if split_archive_identifier(img_path):
+                pixmap = QPixmap()
+                pixmap.loadFromData(read_image_bytes(img_path))
+            else:
+                pixmap = QPixmap(img_path)
             self.img_label.setPixmap(pixmap.scaled(200, 200, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
         except Exception as e:
             self.img_label.setText("无法加载图片")
 
-        self.info_label = QLabel(os.path.basename(img_path))
+        self.info_label = QLabel(os.path.basename(img_path.replace(ARCHIVE_SEPARATOR, os.sep)))
         self.info_label.setWordWrap(True)
         self.info_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
@@ -278,7 +1964,13 @@ class MainWindow(QMainWindow):
         self.setStyleSheet(AppTheme.STYLESHEET)
         
         self.selected_folders = []
+        self.hash_db_path = None
+        self.worker = None
+        self.action_worker = None
+        self.action_engine = BulkActionEngine(os.path.join(os.path.expanduser('~'), '.image_comparator'))
+        self.last_journal = None
         self.image_groups = []
+        self.group_best = []
         self.image_widgets = []
 
         main_widget = QWidget()
@@ -292,6 +1984,13 @@ class MainWindow(QMainWindow):
         self.select_folder_btn = QPushButton("选择文件夹")
         self.select_folder_btn.clicked.connect(self.select_folders)
         
+        self.select_db_btn = QPushButton("加载哈希库")
+        self.select_db_btn.clicked.connect(self.select_hash_db)
+        
+        self.export_db_btn = QPushButton("导出哈希库")
+        self.export_db_btn.clicked.connect(self.export_hash_db)
+        self.export_db_btn.setEnabled(False)
+        
         self.start_btn = QPushButton("开始处理")
         self.start_btn.clicked.connect(self.start_processing)
         self.start_btn.setEnabled(False)
@@ -307,13 +2006,52 @@ class MainWindow(QMainWindow):
         self.hash_size_edit.setText("8")
         self.hash_size_edit.setValidator(QIntValidator(2, 9999, self))
         
+        self.processes_spin = QSpinBox()
+        self.processes_spin.setRange(1, os.cpu_count() or 4); self.processes_spin.setValue(1)
+        
         params_layout.addRow("相似度阈值:", self.threshold_spin)
         params_layout.addRow("哈希大小:", self.hash_size_edit)
+        params_layout.addRow("进程数:", self.processes_spin)
+        
+        self.memory_spin = QSpinBox()
+        self.memory_spin.setRange(0, 1024 * 1024); self.memory_spin.setSingleStep(256)
+        self.memory_spin.setSuffix(" MB"); self.memory_spin.setSpecialValueText("不限制")
+        params_layout.addRow("内存上限:", self.memory_spin)
+        
+        self.orientations_check = QCheckBox("匹配旋转/翻转")
+        params_layout.addRow(self.orientations_check)
+
+        self.clustering_combo = QComboBox()
+        for mode, label in CLUSTERING_MODES.items():
+            self.clustering_combo.addItem(label, mode)
+        params_layout.addRow("分组方式:", self.clustering_combo)
+
+        # 每个已注册的哈希算法一个复选框，只计算勾选的哈希
+        algorithms_layout = QHBoxLayout()
+        self.algorithm_checks = {}
+        for name in HASH_ALGORITHMS:
+            check = QCheckBox(name)
+            check.setChecked(name in DEFAULT_HASH_ALGORITHMS)
+            self.algorithm_checks[name] = check
+            algorithms_layout.addWidget(check)
+        params_layout.addRow("哈希算法:", algorithms_layout)
+
+        self.include_edit = QLineEdit()
+        self.include_edit.setPlaceholderText("如 *.jpg; 2024/*，留空扫描全部")
+        self.exclude_edit = QLineEdit()
+        self.exclude_edit.setPlaceholderText("如 thumbs; *.tmp.png")
+        self.depth_spin = QSpinBox()
+        self.depth_spin.setRange(-1, 999); self.depth_spin.setValue(-1); self.depth_spin.setSpecialValueText("不限")
+        params_layout.addRow("包含:", self.include_edit)
+        params_layout.addRow("排除:", self.exclude_edit)
+        params_layout.addRow("最大深度:", self.depth_spin)
 
         controls_layout.addWidget(self.select_folder_btn)
+        controls_layout.addWidget(self.select_db_btn)
         controls_layout.addWidget(self.folder_label, 1)
         controls_layout.addLayout(params_layout)
         controls_layout.addWidget(self.start_btn)
+        controls_layout.addWidget(self.export_db_btn)
         
         main_layout.addLayout(controls_layout)
 
@@ -334,13 +2072,31 @@ class MainWindow(QMainWindow):
         self.auto_select_btn = QPushButton("自动保留最优")
         self.auto_select_btn.clicked.connect(self.auto_select)
         
-        self.delete_btn = QPushButton("删除选中图片")
+        self.action_combo = QComboBox()
+        self.action_combo.addItem("删除", ACTION_DELETE)
+        self.action_combo.addItem("移至隔离区", ACTION_QUARANTINE)
+        self.action_combo.addItem("替换为硬链接", ACTION_HARDLINK)
+        if REFLINK_SUPPORTED:
+            self.action_combo.addItem("替换为 reflink", ACTION_REFLINK)
+        
+        self.delete_btn = QPushButton("处理选中图片")
         self.delete_btn.clicked.connect(self.delete_selected)
         
+        self.undo_btn = QPushButton("撤销上次操作")
+        self.undo_btn.clicked.connect(self.undo_last_action)
+        self.undo_btn.setEnabled(False)
+        
+        self.purge_btn = QPushButton("清空隔离区")
+        self.purge_btn.clicked.connect(self.purge_last_action)
+        self.purge_btn.setEnabled(False)
+        
         results_actions_layout.addWidget(self.select_all_btn)
         results_actions_layout.addWidget(self.auto_select_btn)
         results_actions_layout.addStretch()
+        results_actions_layout.addWidget(self.action_combo)
         results_actions_layout.addWidget(self.delete_btn)
+        results_actions_layout.addWidget(self.undo_btn)
+        results_actions_layout.addWidget(self.purge_btn)
         main_layout.addWidget(self.results_actions_widget)
         self.results_actions_widget.setVisible(False)
 
@@ -351,22 +2107,41 @@ class MainWindow(QMainWindow):
         self.scroll_area.setWidget(self.results_container)
         main_layout.addWidget(self.scroll_area)
 
+        rolled_back = self.action_engine.recover()
+        if rolled_back:
+            self.status_label.setText(f"已回滚上次中断的 {rolled_back} 个文件操作。")
+
     def select_folders(self):
         folder = QFileDialog.getExistingDirectory(self, "选择文件夹")
         if folder and folder not in self.selected_folders:
             self.selected_folders.append(folder)
+            self.hash_db_path = None
             self.folder_label.setText("; ".join(f"...{folder[-30:]}" for folder in self.selected_folders))
             self.start_btn.setEnabled(True)
 
+    def select_hash_db(self):
+        db_path, _ = QFileDialog.getOpenFileName(self, "选择哈希库", "", "哈希库 (*.simdb);;所有文件 (*)")
+        if db_path:
+            self.hash_db_path = db_path
+            self.folder_label.setText(f"哈希库: ...{db_path[-40:]}")
+            self.start_btn.setEnabled(True)
+
+    def export_hash_db(self):
+        if not self.worker or not self.worker.hashes:
+            self.status_label.setText("没有可导出的哈希值，请先扫描文件夹。")
+            return
+        db_path, _ = QFileDialog.getSaveFileName(self, "导出哈希库", "hashes.simdb", "哈希库 (*.simdb)")
+        if db_path:
+            write_hash_db(db_path, self.worker.hash_size, self.worker.hashes,
+                          self.worker.variants if self.worker.orientations else None, self.worker.algorithms,
+                          self.worker.quality)
+            self.status_label.setText(f"已导出 {len(self.worker.hashes)} 张图片的哈希值到 {db_path}")
+
     def start_processing(self):
         self.start_btn.setEnabled(False); self.select_folder_btn.setEnabled(False)
+        self.export_db_btn.setEnabled(False)
         self.results_actions_widget.setVisible(False)
-        self.image_widgets.clear()
-
-        for i in reversed(range(self.results_layout.count())): 
-            widget_to_remove = self.results_layout.itemAt(i).widget()
-            widget_to_remove.setParent(None)
-            widget_to_remove.deleteLater()
+        self.clear_results()
 
         try:
             hash_size = int(self.hash_size_edit.text())
@@ -374,7 +2149,22 @@ class MainWindow(QMainWindow):
             hash_size = 8
             self.hash_size_edit.setText("8")
 
-        self.worker = Worker(self.selected_folders, self.threshold_spin.value(), hash_size)
+        try:
+            algorithms = resolve_hash_algorithms(
+                [name for name, check in self.algorithm_checks.items() if check.isChecked()], hash_size)
+        except ValueError as e:
+            self.status_label.setText(str(e))
+            self.start_btn.setEnabled(True); self.select_folder_btn.setEnabled(True)
+            return
+
+        self.worker = Worker(self.selected_folders, self.threshold_spin.value(), hash_size, self.processes_spin.value(),
+                             self.hash_db_path, self.orientations_check.isChecked(),
+                             self.memory_spin.value() * 1024 * 1024, algorithms, {
+                                 'include': split_globs(self.include_edit.text()),
+                                 'exclude': split_globs(self.exclude_edit.text()),
+                                 'max_depth': self.depth_spin.value() if self.depth_spin.value() >= 0 else None,
+                                 'dir_index': DirectoryIndex(DIR_INDEX_PATH),
+                             }, self.clustering_combo.currentData())
         self.worker.progress.connect(self.update_progress)
         self.worker.finished.connect(self.show_results)
         self.worker.start()
@@ -382,19 +2172,33 @@ class MainWindow(QMainWindow):
     def update_progress(self, value, status):
         self.progress_bar.setValue(value); self.status_label.setText(status)
 
+    def clear_results(self):
+        self.image_widgets.clear()
+        for i in reversed(range(self.results_layout.count())): 
+            widget_to_remove = self.results_layout.itemAt(i).widget()
+            widget_to_remove.setParent(None)
+            widget_to_remove.deleteLater()
+
     def show_results(self, groups):
         self.image_groups = sorted(groups, key=len, reverse=True)
+        self.group_best = [get_best_image_in_group(group, self.worker.quality) for group in self.image_groups]
         if not self.image_groups:
             self.status_label.setText("处理完成，未找到相似的图片组。")
         else:
             self.status_label.setText(f"处理完成！找到 {len(self.image_groups)} 组相似图片。")
             self.results_actions_widget.setVisible(True)
 
+        self.render_groups()
+        self.start_btn.setEnabled(True); self.select_folder_btn.setEnabled(True)
+        self.export_db_btn.setEnabled(bool(self.worker.hashes))
+
+    def render_groups(self):
+        self.clear_results()
         for i, group in enumerate(self.image_groups):
             group_frame = QFrame(); group_frame.setObjectName("GroupFrame")
             group_layout = QVBoxLayout(group_frame)
             
-            best_image_path = get_best_image_in_group(group)
+            best_image_path = self.group_best[i]
 
             header_layout = QHBoxLayout()
             title_label = QLabel(f"第 {i+1} 组 (共 {len(group)} 张图片)")
@@ -423,8 +2227,6 @@ class MainWindow(QMainWindow):
             group_layout.addWidget(group_scroll_area)
             self.results_layout.addWidget(group_frame)
 
-        self.start_btn.setEnabled(True); self.select_folder_btn.setEnabled(True)
-
     def select_group(self, group_widgets):
         is_any_not_selected = any(not w.is_selected for w in group_widgets)
         for widget in group_widgets:
@@ -440,30 +2242,201 @@ class MainWindow(QMainWindow):
             widget.set_selected(not widget.is_best)
 
     def delete_selected(self):
-        selected_paths = [w.img_path for w in self.image_widgets if w.is_selected]
+        selected_paths = {w.img_path for w in self.image_widgets if w.is_selected}
         if not selected_paths:
             self.status_label.setText("没有选中任何图片。")
             return
-        
-        deleted_count = 0
-        for path in selected_paths:
-            try:
-                os.remove(path)
-                deleted_count += 1
-            except OSError as e:
-                print(f"Error deleting {path}: {e}")
-        
-        self.status_label.setText(f"成功删除了 {deleted_count} 张图片，请重新处理以更新视图。")
-        self.results_actions_widget.setVisible(False)
-        
-        for i in reversed(range(self.results_layout.count())): 
-            widget_to_remove = self.results_layout.itemAt(i).widget()
-            widget_to_remove.setParent(None)
-            widget_to_remove.deleteLater()
-        self.image_widgets.clear()
+
+        action = self.action_combo.currentData()
+        plan, skipped_count = [], 0
+        for group, best in zip(self.image_groups, self.group_best):
+            # 链接替换需要本组中一张未选中的图片作为保留的原件
+            keepers = [p for p in group if p not in selected_paths and not split_archive_identifier(p)]
+            keeper = best if best in keepers else (keepers[0] if keepers else None)
+            for path in group:
+                if path not in selected_paths: continue
+                if split_archive_identifier(path) or (action in LINK_ACTIONS and keeper is None):
+                    skipped_count += 1  # 压缩包中的图片不能单独处理
+                    continue
+                plan.append((action, path, keeper))
+
+        if not plan:
+            self.status_label.setText(f"没有可处理的图片，跳过了 {skipped_count} 张。")
+            return
+
+        self.delete_btn.setEnabled(False); self.undo_btn.setEnabled(False); self.purge_btn.setEnabled(False)
+        self.skipped_count = skipped_count
+        self.action_worker = ActionWorker(self.action_engine, plan)
+        self.action_worker.progress.connect(self.update_progress)
+        self.action_worker.finished.connect(self.on_action_finished)
+        self.action_worker.start()
+
+    def on_action_finished(self, journal_path, completed, failed):
+        self.last_journal = journal_path
+        processed = {entry['path']: entry for entry in completed}
+        hashes = self.worker.hashes if self.worker else {}
+        variants = self.worker.variants if self.worker else {}
+        for entry in completed:
+            # 原地更新哈希缓存：删除/隔离的图片移除，替换为链接的图片内容与保留的原件相同
+            if entry['action'] in LINK_ACTIONS and entry['keeper'] in hashes:
+                hashes[entry['path']] = hashes[entry['keeper']]
+                variants[entry['path']] = variants.get(entry['keeper'], [hashes[entry['keeper']]])
+            else:
+                hashes.pop(entry['path'], None)
+                variants.pop(entry['path'], None)
+
+        # 原地更新分组，无需重新扫描
+        remaining_groups, remaining_best = [], []
+        for group, best in zip(self.image_groups, self.group_best):
+            group = [p for p in group if p not in processed]
+            if len(group) < 2: continue
+            remaining_groups.append(group)
+            remaining_best.append(best if best in group else get_best_image_in_group(group, self.worker.quality))
+        self.image_groups, self.group_best = remaining_groups, remaining_best
+        self.render_groups()
+
+        skipped_text = f"，跳过 {self.skipped_count} 张" if self.skipped_count else ""
+        failed_text = f"，失败 {len(failed)} 张" if failed else ""
+        self.status_label.setText(f"成功处理了 {len(completed)} 张图片{skipped_text}{failed_text}。")
+        self.progress_bar.setValue(100)
+        self.results_actions_widget.setVisible(True)
+        self.delete_btn.setEnabled(True)
+        self.undo_btn.setEnabled(bool(completed))
+        self.purge_btn.setEnabled(any(entry['backup'] for entry in completed))
+
+    def undo_last_action(self):
+        if not self.last_journal: return
+        restored, unrecoverable = self.action_engine.undo(self.last_journal)
+        unrecoverable_text = f"，{len(unrecoverable)} 张已删除的图片无法恢复" if unrecoverable else ""
+        self.status_label.setText(f"已恢复 {len(restored)} 张图片{unrecoverable_text}，请重新处理以更新视图。")
+        self.last_journal = None
+        self.undo_btn.setEnabled(False); self.purge_btn.setEnabled(False)
+
+    def purge_last_action(self):
+        if not self.last_journal: return
+        purged = self.action_engine.purge(self.last_journal)
+        self.status_label.setText(f"已清空隔离区中的 {purged} 个文件，此操作无法撤销。")
+        self.last_journal = None
+        self.undo_btn.setEnabled(False); self.purge_btn.setEnabled(False)
+
+
+# ==============================================================================
+#  命令行入口：分片 / 合并 / 本机多进程扫描，无参数时启动 GUI
+# ==============================================================================
+def write_groups(groups, output_path, quality=None):
+    """输出相似组，每组按画质从好到坏排序，第一张即建议保留的图片"""
+    groups = [rank_group(group, quality) for group in groups]
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(groups, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(groups, sys.stdout, ensure_ascii=False, indent=2)
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(description="图片比较器命令行模式")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    shard_parser = subparsers.add_parser('shard', help="扫描一个分片并写出分片文件")
+    shard_parser.add_argument('folders', nargs='+')
+    shard_parser.add_argument('--index', type=int, required=True)
+    shard_parser.add_argument('--count', type=int, required=True)
+    shard_parser.add_argument('--out', required=True)
+
+    merge_parser = subparsers.add_parser('merge', help="合并分片文件并输出相似组")
+    merge_parser.add_argument('shards', nargs='+')
+    merge_parser.add_argument('--out')
+    merge_parser.add_argument('--workers', type=int)
+
+    scan_parser = subparsers.add_parser('scan', help="在本机用多个进程分片扫描")
+    scan_parser.add_argument('folders', nargs='+')
+    scan_parser.add_argument('--processes', type=int, default=os.cpu_count() or 4)
+    scan_parser.add_argument('--work-dir')
+    scan_parser.add_argument('--out')
+
+    export_parser = subparsers.add_parser('export', help="计算哈希值并导出为二进制哈希库")
+    export_parser.add_argument('folders', nargs='+')
+    export_parser.add_argument('--out', required=True)
+
+    for sub in (merge_parser, scan_parser):
+        sub.add_argument('--clustering', choices=list(CLUSTERING_MODES), default=DEFAULT_CLUSTERING,
+                         help="分组方式: connected 连通分量, leader 中心聚类, complete 完全链接")
+
+    for sub in (scan_parser, export_parser):
+        sub.add_argument('--max-memory', type=parse_memory_size,
+                         help="内存上限，如 512M、2G；超出时把哈希和候选对溢出到磁盘")
+
+    for sub in (shard_parser, scan_parser, export_parser):
+        sub.add_argument('--threshold', type=float, default=80.0)
+        sub.add_argument('--hash-size', type=int, default=8)
+        sub.add_argument('--orientations', action='store_true', help="同时匹配 8 种旋转/翻转方向")
+        sub.add_argument('--algorithms', default=','.join(DEFAULT_HASH_ALGORITHMS),
+                         help=f"逗号分隔的哈希算法，可用: {', '.join(HASH_ALGORITHMS)}")
+        sub.add_argument('--include', action='append', default=[], help="只扫描匹配的文件，如 '*.jpg'，可重复")
+        sub.add_argument('--exclude', action='append', default=[], help="跳过匹配的文件和目录，如 'raw/*'，可重复")
+        sub.add_argument('--max-depth', type=int, help="最多进入几层子目录，0 表示只扫描根目录")
+        sub.add_argument('--dir-index', default=DIR_INDEX_PATH, help="目录 mtime 索引文件")
+        sub.add_argument('--no-dir-index', action='store_true', help="不读写目录 mtime 索引")
+
+    args = parser.parse_args(argv)
+    if args.command != 'merge':
+        try:
+            args.algorithms = resolve_hash_algorithms(args.algorithms, args.hash_size)
+        except ValueError as e:
+            parser.error(str(e))
+        walk_options = {'include': args.include, 'exclude': args.exclude, 'max_depth': args.max_depth,
+                        'dir_index': None if args.no_dir_index else DirectoryIndex(args.dir_index)}
+    if args.command == 'shard':
+        paths = [p for p in collect_image_sources(args.folders, **walk_options)
+                 if shard_for_path(p, args.count) == args.index]
+        scan_shard(paths, args.hash_size, args.threshold, args.out, args.index, args.count, args.orientations,
+                   args.algorithms)
+    elif args.command == 'merge':
+        quality = {}
+        write_groups(merge_shards(args.shards, args.workers, quality, args.clustering), args.out, quality)
+    elif args.command == 'scan' and args.max_memory:
+        quality = {}
+        with tempfile.TemporaryDirectory(prefix='similarity-spill-', dir=args.work_dir) as work_dir:
+            groups = run_budgeted_scan(args.folders, args.threshold, args.hash_size, args.max_memory, work_dir,
+                                       args.processes, args.orientations, algorithms=args.algorithms,
+                                       walk_options=walk_options, quality=quality, clustering=args.clustering)
+        write_groups(groups, args.out, quality)
+    elif args.command == 'scan':
+        quality = {}
+        if args.work_dir:
+            groups = run_sharded_scan(args.folders, args.threshold, args.hash_size, args.processes, args.work_dir,
+                                      orientations=args.orientations, algorithms=args.algorithms,
+                                      walk_options=walk_options, quality=quality, clustering=args.clustering)
+        else:
+            with tempfile.TemporaryDirectory(prefix='similarity-shards-') as work_dir:
+                groups = run_sharded_scan(args.folders, args.threshold, args.hash_size, args.processes, work_dir,
+                                          orientations=args.orientations, algorithms=args.algorithms,
+                                          walk_options=walk_options, quality=quality, clustering=args.clustering)
+        write_groups(groups, args.out, quality)
+    elif args.command == 'export' and args.max_memory:
+        writer = HashDbWriter(args.out, args.hash_size, len(ORIENTATIONS) if args.orientations else 1,
+                              MemoryBudget(args.max_memory), args.algorithms)
+        pending_quality = {}
+        for items in iter_source_variants(collect_image_sources(args.folders, **walk_options), args.hash_size, args.orientations,
+                                          algorithms=args.algorithms, quality=pending_quality):
+            for path, hash_variants in items:
+                writer.add(path, hash_variants, pending_quality.pop(path, None))
+        writer.close()
+    elif args.command == 'export':
+        quality = {}
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+            variants = dict(item for items in executor.map(
+                lambda p: calculate_source_variants(p, args.hash_size, args.orientations, args.algorithms, quality),
+                collect_image_sources(args.folders, **walk_options)) for item in items)
+        hashes = {path: hash_variants[0] for path, hash_variants in variants.items()}
+        write_hash_db(args.out, args.hash_size, hashes, variants if args.orientations else None, args.algorithms,
+                      quality)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+        sys.exit(0)
     app = QApplication(sys.argv)
     if os.path.exists('icon.ico'):
         app.setWindowIcon(QIcon('icon.ico'))
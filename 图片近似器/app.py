@@ -4,7 +4,7 @@ import io
 import threading
 import tkinter as tk
 from tkinter import filedialog
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, session
 from flask_socketio import SocketIO
 from PIL import Image
 import imagehash
@@ -12,9 +12,27 @@ from werkzeug.utils import secure_filename
 import tempfile
 import webbrowser
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import hashlib
 import logging
+import json
+import struct
+import sys
+import argparse
+import ctypes
+import ctypes.util
+import select
+import shutil
+import errno
+import uuid
+import functools
+import fnmatch
+import gzip
+import re
+import tarfile
+import zipfile
+from collections import deque
+import numpy
 
 # 配置日志
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,17 +43,21 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
-app.config['THREAD_POOL_SIZE'] = 4  # 线程池大小
+app.config['THREAD_POOL_SIZE'] = os.cpu_count() or 4  # 线程池大小，所有任务共享
+app.config['MAX_ACTIVE_JOBS'] = 8  # 同时排队和运行的任务上限，超出时拒绝新任务
+app.config['INDEX_POOL_SIZE'] = max(1, app.config['THREAD_POOL_SIZE'] // 2)  # 监视模式建立索引用的独立线程池
+app.config['SESSION_IDLE_SECONDS'] = 2 * 3600  # 会话闲置超过这个时间且没有任务和监视时清除
 
 # 添加SocketIO支持
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # 全局变量
-selected_folders = []
-reference_image_path = None
-similar_images = []
+sessions = {}  # 会话ID -> SessionState，每个浏览器会话的扫描状态互不干扰
+sessions_lock = threading.Lock()
 image_hash_cache = {}  # 图片哈希缓存
-executor = ThreadPoolExecutor(max_workers=app.config['THREAD_POOL_SIZE'])  # 线程池
+executor = ThreadPoolExecutor(max_workers=app.config['THREAD_POOL_SIZE'])  # 线程池，只由 JobManager 调度
+# 建立监视索引要一次哈希整个文件夹，放在单独的线程池中，不占用任务的调度名额
+index_executor = ThreadPoolExecutor(max_workers=app.config['INDEX_POOL_SIZE'])
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'webp'}
@@ -57,11 +79,82 @@ def get_file_hash(file_path):
         logger.error(f"Error getting file hash for {file_path}: {e}")
         return None
 
+# 压缩包扫描：不解压到磁盘，直接从 zip/tar 中流式读取图片，标识为 "压缩包!成员"，与图片比较器导出的哈希库一致
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_SEPARATOR = '!'
+MAX_ARCHIVE_MEMBER_SIZE = 256 * 1024 * 1024  # 单个成员读入内存的上限
+_ARCHIVE_IDENTIFIER = re.compile(
+    r'^(.*?(?:' + '|'.join(re.escape(ext) for ext in ARCHIVE_EXTENSIONS) + r'))' + re.escape(ARCHIVE_SEPARATOR) + r'(.+)$',
+    re.IGNORECASE)
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def split_archive_identifier(identifier):
+    """把 "压缩包!成员" 拆成 (压缩包路径, 成员名)，普通文件返回 None"""
+    match = _ARCHIVE_IDENTIFIER.match(identifier)
+    if match and os.path.isfile(match.group(1)):
+        return match.group(1), match.group(2)
+    return None
+
+def archive_of(identifier):
+    """返回标识所属的压缩包路径，普通文件返回 None。压缩包已被删除时也能识别"""
+    match = _ARCHIVE_IDENTIFIER.match(identifier)
+    return match.group(1) if match else None
+
+def iter_archive_images(archive_path):
+    """按顺序流式读取压缩包中的图片，产出 (标识, 内存文件)。同一时间只持有一个成员的数据"""
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not allowed_file(info.filename) or info.file_size > MAX_ARCHIVE_MEMBER_SIZE:
+                        continue
+                    yield f"{archive_path}{ARCHIVE_SEPARATOR}{info.filename}", io.BytesIO(archive.read(info))
+        else:
+            # 流模式只顺序读取一遍，压缩的 tar 也不需要回退
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or not allowed_file(member.name) or member.size > MAX_ARCHIVE_MEMBER_SIZE:
+                        continue
+                    yield f"{archive_path}{ARCHIVE_SEPARATOR}{member.name}", io.BytesIO(archive.extractfile(member).read())
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+        logger.error(f"Error reading archive {archive_path}: {e}")
+
+def read_image_bytes(identifier):
+    """读取压缩包成员的原始字节，用于预览和按需计算哈希"""
+    archive_path, member_name = split_archive_identifier(identifier)
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.read(member_name)
+    with tarfile.open(archive_path, 'r:*') as archive:
+        return archive.extractfile(member_name).read()
+
+def open_image_source(identifier):
+    if split_archive_identifier(identifier):
+        return Image.open(io.BytesIO(read_image_bytes(identifier)))
+    return Image.open(identifier)
+
+def image_source_size(identifier):
+    """文件或压缩包成员的字节数，不存在时返回 0"""
+    try:
+        archive_member = split_archive_identifier(identifier)
+        if not archive_member:
+            return os.path.getsize(identifier)
+        archive_path, member_name = archive_member
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                return archive.getinfo(member_name).file_size
+        with tarfile.open(archive_path, 'r:*') as archive:
+            return archive.getmember(member_name).size
+    except (OSError, KeyError, tarfile.TarError, zipfile.BadZipFile):
+        return 0
+
 def image_to_base64(image_path, max_size=300):
     """将图片转换为base64编码，优化内存使用"""
     try:
         # 使用PIL读取图片
-        with Image.open(image_path) as img:
+        with open_image_source(image_path) as img:
             # 调整图片大小以加快加载速度
             if max(img.size) > max_size:
                 ratio = max_size / max(img.size)
@@ -84,51 +177,119 @@ def image_to_base64(image_path, max_size=300):
         logger.error(f"Error converting image to base64: {e}")
         return ""
 
-def calculate_image_hashes(image_path, hash_size=8):
-    """计算图片的多种哈希值"""
-    file_hash = get_file_hash(image_path)
+class HashAlgorithm:
+    """一种感知哈希算法。
+
+    compute(图片, hash_size) 返回 ImageHash；bits(hash_size) 为哈希位数；weight 为综合相似度中的权重；
+    cost 为相对比较开销，评分时先比较便宜的算法。
+    """
+
+    def __init__(self, name, compute, weight, cost=1.0, bits=None, supports=None):
+        self.name = name
+        self.compute = compute
+        self.weight = weight
+        self.cost = cost
+        self.bits = bits or (lambda hash_size: hash_size * hash_size)
+        self.supports = supports or (lambda hash_size: True)
+
+    def hex_width(self, hash_size):
+        return (self.bits(hash_size) + 3) // 4
+
+HASH_ALGORITHMS = {}
+
+def register_hash_algorithm(algorithm):
+    """注册哈希算法，之后即可在 algorithms 配置中使用"""
+    HASH_ALGORITHMS[algorithm.name] = algorithm
+    return algorithm
+
+register_hash_algorithm(HashAlgorithm('phash', lambda image, hash_size: imagehash.phash(image, hash_size=hash_size), 0.5))
+register_hash_algorithm(HashAlgorithm('ahash', lambda image, hash_size: imagehash.average_hash(image, hash_size=hash_size), 0.3))
+register_hash_algorithm(HashAlgorithm('dhash', lambda image, hash_size: imagehash.dhash(image, hash_size=hash_size), 0.2))
+register_hash_algorithm(HashAlgorithm('whash', lambda image, hash_size: imagehash.whash(image, hash_size=hash_size), 0.2,
+                                      supports=lambda hash_size: hash_size & (hash_size - 1) == 0))
+register_hash_algorithm(HashAlgorithm('colorhash', lambda image, hash_size: imagehash.colorhash(image, binbits=3), 0.2,
+                                      cost=0.5, bits=lambda hash_size: 14 * 3))
+
+DEFAULT_HASH_ALGORITHMS = ('phash', 'ahash', 'dhash')
+SCORE_EPSILON = 1e-9  # 浮点累加误差的容差，剪枝只在确定达不到阈值时发生
+
+def resolve_hash_algorithms(names, hash_size=None):
+    """校验算法配置，返回算法名元组；未提供（None）时使用默认算法，名称未注册、选择为空或不支持当前 hash_size 时抛出 ValueError"""
+    if names is None:
+        return DEFAULT_HASH_ALGORITHMS
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    names = tuple(dict.fromkeys(names))
+    if not names:
+        raise ValueError("至少需要选择一种哈希算法")
+    for name in names:
+        if name not in HASH_ALGORITHMS:
+            raise ValueError(f"未知的哈希算法: {name}")
+        if hash_size is not None and not HASH_ALGORITHMS[name].supports(hash_size):
+            raise ValueError(f"哈希算法 {name} 不支持哈希大小 {hash_size}")
+    return names
+
+@functools.lru_cache(maxsize=None)
+def scoring_plan(algorithms):
+    """返回 (评分顺序, 总权重)。顺序按比较开销从低到高，开销相同时权重大的在前"""
+    order = sorted(algorithms, key=lambda name: (HASH_ALGORITHMS[name].cost, -HASH_ALGORITHMS[name].weight))
+    return tuple(order), sum(HASH_ALGORITHMS[name].weight for name in algorithms)
+
+def calculate_image_hashes(image_path, hash_size=8, algorithms=DEFAULT_HASH_ALGORITHMS, fileobj=None):
+    """计算图片的多种哈希值，只计算 algorithms 中缓存里还没有的哈希。
+
+    压缩包成员可以直接传入已读出的内存文件 fileobj，否则按标识从压缩包中读取。
+    """
+    if fileobj is None and split_archive_identifier(image_path):
+        try:
+            fileobj = io.BytesIO(read_image_bytes(image_path))
+        except (OSError, KeyError, tarfile.TarError, zipfile.BadZipFile) as e:
+            logger.error(f"Error reading {image_path}: {e}")
+            return None
+    file_hash = hashlib.md5(fileobj.getvalue()).hexdigest() if fileobj is not None else get_file_hash(image_path)
     if not file_hash:
         return None
     
     # 检查缓存
-    if file_hash in image_hash_cache:
-        return image_hash_cache[file_hash]
-    
-    try:
-        with Image.open(image_path) as image:
-            phash = str(imagehash.phash(image, hash_size=hash_size))
-            ahash = str(imagehash.average_hash(image, hash_size=hash_size))
-            dhash = str(imagehash.dhash(image, hash_size=hash_size))
-            
-            # 存入缓存
-            image_hash_cache[file_hash] = {
-                'phash': phash,
-                'ahash': ahash,
-                'dhash': dhash,
-                'timestamp': time.time()
-            }
-            
-            return {
-                'phash': phash,
-                'ahash': ahash,
-                'dhash': dhash
-            }
-    except Exception as e:
-        logger.error(f"Error calculating hashes for {image_path}: {e}")
-        return None
+    cached = image_hash_cache.get(file_hash)
+    if not cached or cached.get('hash_size') != hash_size:
+        cached = {'hash_size': hash_size}
+    missing = [name for name in algorithms if name not in cached]
+    if missing:
+        try:
+            with Image.open(fileobj if fileobj is not None else image_path) as image:
+                for name in missing:
+                    cached[name] = str(HASH_ALGORITHMS[name].compute(image, hash_size))
+        except Exception as e:
+            logger.error(f"Error calculating hashes for {image_path}: {e}")
+            return None
+        # 存入缓存
+        cached['timestamp'] = time.time()
+        image_hash_cache[file_hash] = cached
+    return {name: cached[name] for name in algorithms}
 
-def calculate_similarity(hashes1, hashes2):
-    """计算两个哈希集合的综合相似度"""
+def calculate_similarity(hashes1, hashes2, threshold=None):
+    """计算两个哈希集合的综合相似度（两者共有算法的加权平均）。
+
+    给出 threshold 时按开销从低到高累加，一旦剩余算法全部 100% 相似也达不到阈值就提前返回这个上界（必然低于阈值）。
+    """
     if not hashes1 or not hashes2:
         return 0
+    algorithms = tuple(name for name in HASH_ALGORITHMS if name in hashes1 and name in hashes2)
+    if not algorithms:
+        return 0
     
-    # 计算各种哈希的相似度
-    phash_sim = calculate_similarity_value(hashes1['phash'], hashes2['phash'])
-    ahash_sim = calculate_similarity_value(hashes1['ahash'], hashes2['ahash'])
-    dhash_sim = calculate_similarity_value(hashes1['dhash'], hashes2['dhash'])
+    order, total_weight = scoring_plan(algorithms)
+    combined, remaining_weight = 0.0, total_weight
+    for name in order:
+        weight = HASH_ALGORITHMS[name].weight
+        combined += calculate_similarity_value(hashes1[name], hashes2[name]) * weight
+        remaining_weight -= weight
+        if threshold is not None and combined + remaining_weight * 100 < threshold * total_weight - SCORE_EPSILON:
+            return (combined + remaining_weight * 100) / total_weight
     
     # 综合相似度（加权平均）
-    return (phash_sim * 0.5 + ahash_sim * 0.3 + dhash_sim * 0.2)
+    return combined / total_weight
 
 def calculate_similarity_value(hash1, hash2):
     """计算两个哈希值之间的相似度"""
@@ -139,101 +300,592 @@ def calculate_similarity_value(hash1, hash2):
     distance = sum(c1 != c2 for c1, c2 in zip(hash1, hash2))
     return (1 - distance / max_distance) * 100
 
-def find_similar_images(reference_path, folder_paths, threshold, hash_size, socket_id=None):
-    """在文件夹中查找与参考图片相似的图片"""
-    global similar_images
-    similar_images = []
-    
-    if not reference_path or not folder_paths:
-        return []
-    
-    # 计算参考图片的哈希值
-    ref_hashes = calculate_image_hashes(reference_path, hash_size)
-    if not ref_hashes:
+# 二进制哈希库（与图片比较器导出的 .simdb 格式相同）
+# 布局: MAGIC(8) | 版本 uint32 | 头部长度 uint32 | 头部 JSON | 填充到 64 字节对齐 | 数据区
+HASH_DB_MAGIC = b'SIMHASHD'
+HASH_DB_VERSION = 1
+HASH_DB_PREAMBLE = struct.Struct('<8sII')
+HASH_DB_ALIGN = 64
+
+class HashDatabase:
+    """只读打开二进制哈希库，哈希列和路径表都通过 numpy.memmap 按需读取"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with open(db_path, 'rb') as f:
+            magic, version, header_len = HASH_DB_PREAMBLE.unpack(f.read(HASH_DB_PREAMBLE.size))
+            if magic != HASH_DB_MAGIC or version != HASH_DB_VERSION:
+                raise ValueError(f"不支持的哈希库文件: {db_path}")
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        align = HASH_DB_ALIGN
+        self.data_start = (HASH_DB_PREAMBLE.size + header_len + align - 1) // align * align
+        self.hash_size = self.header['hash_size']
+        self.count = self.header['count']
+        # 只使用本程序已注册的算法
+        self.algorithms = tuple(name for name in self.header.get('algorithms', DEFAULT_HASH_ALGORITHMS)
+                                if name in HASH_ALGORITHMS)
+        self._columns = {}
+        self._string_offsets = self.column('string_offsets')
+        strings = self.header['strings']
+        self._string_data = numpy.memmap(db_path, dtype=numpy.uint8, mode='r',
+                                         offset=self.data_start + strings['offset'],
+                                         shape=(strings['size'],)) if strings['size'] else b''
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        if name not in self._columns:
+            spec = self.header['columns'][name]
+            if 0 in spec['shape']:
+                self._columns[name] = numpy.zeros(spec['shape'], dtype=spec['dtype'])
+            else:
+                self._columns[name] = numpy.memmap(self.db_path, dtype=spec['dtype'], mode='r',
+                                                   offset=self.data_start + spec['offset'],
+                                                   shape=tuple(spec['shape']))
+        return self._columns[name]
+
+    def path(self, index):
+        start, end = int(self._string_offsets[index]), int(self._string_offsets[index + 1])
+        return bytes(self._string_data[start:end]).decode('utf-8')
+
+    def hex_hashes(self, index):
+        """把第 index 张图片的哈希还原成与 calculate_image_hashes 相同的十六进制字符串"""
+        return {name: format(int.from_bytes(self.column(name)[index].astype('>u8').tobytes(), 'big'),
+                             f'0{HASH_ALGORITHMS[name].hex_width(self.hash_size)}x') for name in self.algorithms}
+
+def hex_to_words(hex_str, words):
+    """把十六进制哈希字符串转换成与哈希列相同布局的 uint64 数组"""
+    value = int(hex_str, 16)
+    return numpy.array([(value >> (64 * (words - 1 - k))) & 0xFFFFFFFFFFFFFFFF for k in range(words)],
+                       dtype=numpy.uint64)
+
+def count_hex_differences(words, reference_words):
+    """逐行统计与参考哈希不同的十六进制位数，与 calculate_similarity_value 的逐字符比较一致"""
+    diff = numpy.bitwise_xor(words, reference_words)
+    count = numpy.zeros(diff.shape[0], dtype=numpy.int64)
+    for shift in range(0, 64, 4):
+        count += (((diff >> numpy.uint64(shift)) & numpy.uint64(0xF)) != 0).sum(axis=1)
+    return count
+
+def score_hash_columns(column, reference_hashes, algorithms, hash_size, threshold, rows):
+    """对 rows 行按开销顺序累加加权相似度，每一步都剔除已不可能达到阈值的行，后面的列只比较剩下的行。
+
+    column(name) 返回该算法的 uint64 哈希列，返回 (达到阈值的行, 相似度)。
+    """
+    order, total_weight = scoring_plan(tuple(algorithms))
+    combined, remaining_weight = numpy.zeros(len(rows)), total_weight
+    for name in order:
+        algorithm = HASH_ALGORITHMS[name]
+        words = column(name)
+        distance = count_hex_differences(words[rows], hex_to_words(reference_hashes[name], words.shape[1]))
+        combined = combined + (1 - distance / algorithm.hex_width(hash_size)) * 100 * algorithm.weight
+        remaining_weight -= algorithm.weight
+        keep = combined + remaining_weight * 100 >= threshold * total_weight - SCORE_EPSILON
+        rows, combined = rows[keep], combined[keep]
+    combined = combined / total_weight
+    keep = combined >= threshold
+    return rows[keep], combined[keep]
+
+def build_image_result(image_path, similarity):
+    """构造返回给前端的图片信息"""
+    return {
+        "path": image_path,
+        "name": os.path.basename(image_path),
+        "base64": image_to_base64(image_path),
+        "size": image_source_size(image_path),
+        "similarity": similarity
+    }
+
+def match_images_in_db(reference_path, db_path, threshold):
+    """在二进制哈希库中查找与参考图片相似的图片，无需遍历文件夹和重新计算哈希，返回 [(路径, 相似度)]"""
+    db = HashDatabase(db_path)
+    if not db.algorithms:
+        raise ValueError('哈希库中没有可用的哈希算法')
+    ref_hashes = calculate_image_hashes(reference_path, db.hash_size, db.algorithms)
+    if not ref_hashes or not len(db):
         return []
-    
-    # 收集所有图片文件
-    image_paths = []
-    for folder_path in folder_paths:
-        folder_path = os.path.normpath(folder_path)
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                if allowed_file(file):
-                    full_path = os.path.normpath(os.path.join(root, file))
-                    if full_path != reference_path:
-                        image_paths.append(full_path)
-    
-    total_images = len(image_paths)
-    if socket_id:
-        socketio.emit('progress', {
-            'current': 0, 
-            'total': total_images, 
-            'percent': 0, 
-            'status': '开始比较图片相似度...',
-            'stage': 'compare'
-        }, room=socket_id)
-    
-    # 使用线程池处理图片
-    processed_count = 0
-    lock = threading.Lock()
-    
-    def process_image(image_path):
-        nonlocal processed_count
-        
-        # 计算图片哈希
-        img_hashes = calculate_image_hashes(image_path, hash_size)
-        if not img_hashes:
+
+    rows, combined = score_hash_columns(db.column, ref_hashes, db.algorithms, db.hash_size, threshold,
+                                        numpy.flatnonzero(db.column('valid')))
+
+    normalized_reference = os.path.normpath(reference_path)
+    matches = [(db.path(i), float(similarity)) for i, similarity in zip(rows, combined)]
+    return [(path, similarity) for path, similarity in matches if os.path.normpath(path) != normalized_reference]
+
+# 目录遍历：多线程 os.scandir，支持包含/排除通配符、深度限制和持久化的目录 mtime 索引
+DIR_INDEX_VERSION = 1
+DIR_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.image_similarity', 'dir_index.json.gz')
+DIR_INDEX_SETTLE_NS = 2 * 10 ** 9  # 刚修改过的目录不写入索引，避免同一 mtime 精度内的后续修改被漏掉
+
+class DirectoryIndex:
+    """持久化的目录列表缓存：{目录: [mtime_ns, 文件名列表, 子目录名列表]}，保存为 gzip JSON。
+
+    目录的 mtime 只在其直接子项增删或改名时变化，所以 mtime 未变的目录直接复用上次的列表而不再 scandir；
+    更深层的变化要看各子目录自己的 mtime，因此每个子目录仍需一次 stat。
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if index_path and os.path.exists(index_path):
+            try:
+                with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == DIR_INDEX_VERSION:
+                    self.entries = data['directories']
+            except (OSError, ValueError, KeyError):
+                self.entries = {}
+
+    def lookup(self, path, mtime_ns):
+        entry = self.entries.get(path)
+        if entry and entry[0] == mtime_ns:
+            return entry[1], entry[2]
+        return None
+
+    def store(self, path, mtime_ns, files, dirs):
+        if time.time_ns() - mtime_ns < DIR_INDEX_SETTLE_NS:
             return
-        
-        # 计算相似度
-        similarity = calculate_similarity(ref_hashes, img_hashes)
-        
-        # 如果相似度超过阈值，添加到结果中
-        if similarity >= threshold:
-            with lock:
-                similar_images.append({
-                    "path": image_path,
-                    "name": os.path.basename(image_path),
-                    "base64": image_to_base64(image_path),
-                    "size": os.path.getsize(image_path) if os.path.exists(image_path) else 0,
-                    "similarity": similarity
-                })
-        
-        # 更新进度
-        with lock:
-            nonlocal processed_count
-            processed_count += 1
-            if socket_id and processed_count % 5 == 0:
-                progress = int((processed_count / total_images) * 100)
-                socketio.emit('progress', {
-                    'current': processed_count, 
-                    'total': total_images, 
-                    'percent': progress,
-                    'status': f'正在比较图片 {os.path.basename(image_path)}...',
-                    'stage': 'compare'
-                }, room=socket_id)
-    
-    # 提交所有任务到线程池
-    futures = [executor.submit(process_image, path) for path in image_paths]
-    
-    # 等待所有任务完成
-    for future in futures:
-        future.result()
-    
-    # 按相似度降序排序
-    similar_images.sort(key=lambda x: x['similarity'], reverse=True)
-    
-    # 发送完成进度
-    if socket_id:
-        socketio.emit('progress', {
-            'current': total_images, 
-            'total': total_images, 
-            'percent': 100,
-            'status': '处理完成！',
-            'stage': 'complete'
-        }, room=socket_id)
-    
-    return similar_images
+        with self.lock:
+            self.entries[path] = [mtime_ns, files, dirs]
+            self.dirty = True
+
+    def prune(self, roots, visited):
+        """删除这些根目录下本次没有遍历到（已删除）的目录"""
+        prefixes = [os.path.join(root, '') for root in roots]
+        with self.lock:
+            stale = [path for path in self.entries
+                     if path not in visited and any(path.startswith(prefix) for prefix in prefixes)]
+            for path in stale:
+                del self.entries[path]
+            self.dirty = self.dirty or bool(stale)
+
+    def save(self):
+        if not self.index_path or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump({'version': DIR_INDEX_VERSION, 'directories': self.entries}, f,
+                          ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+
+def scan_directory(path, mtime_ns, dir_index=None):
+    """返回目录的 (文件名列表, [(子目录名, mtime_ns), ...])。子目录的 mtime 取自 DirEntry 的 stat。"""
+    key = os.path.abspath(path)
+    cached = dir_index.lookup(key, mtime_ns) if dir_index else None
+    if cached:
+        files, names = cached
+        dirs = []
+        for name in names:
+            try:
+                dirs.append((name, os.stat(os.path.join(path, name)).st_mtime_ns))
+            except OSError:
+                continue
+        return files, dirs
+
+    files, dirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append((entry.name, entry.stat(follow_symlinks=False).st_mtime_ns))
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                continue
+    if dir_index:
+        dir_index.store(key, mtime_ns, files, [name for name, _ in dirs])
+    return files, dirs
+
+def match_globs(relative_path, name, patterns):
+    # 含 '/' 的通配符匹配相对路径，否则只匹配名称
+    return any(fnmatch.fnmatch(relative_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+def walk_files(folder_paths, match=None, include=None, exclude=None, max_depth=None, dir_index=None,
+               max_workers=None):
+    """多线程遍历文件夹，返回满足 match(文件名) 和包含/排除通配符的文件路径（已排序、去重）。
+
+    include 只作用于文件；exclude 同时作用于文件和目录，被排除的目录整棵跳过。
+    max_depth 为 0 时只看根目录中的文件。隔离区目录始终跳过。
+    """
+    include, exclude = list(include or []), list(exclude or [])
+    # 统一成绝对路径，相对路径和绝对路径写法的同一（或嵌套）文件夹才能去重
+    folder_paths = list(dict.fromkeys(os.path.abspath(folder_path) for folder_path in folder_paths))
+    results, visited = [], set()
+    with ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 4) * 4)) as executor:
+        pending = {}
+        for folder_path in folder_paths:
+            try:
+                mtime_ns = os.stat(folder_path).st_mtime_ns
+            except OSError:
+                continue
+            pending[executor.submit(scan_directory, folder_path, mtime_ns, dir_index)] = (folder_path, '', 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path, relative, depth = pending.pop(future)
+                try:
+                    files, dirs = future.result()
+                except OSError:
+                    continue
+                visited.add(os.path.abspath(dir_path))
+                for name in files:
+                    if match and not match(name): continue
+                    if include and not match_globs(relative + name, name, include): continue
+                    if exclude and match_globs(relative + name, name, exclude): continue
+                    results.append(os.path.join(dir_path, name))
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for name, mtime_ns in dirs:
+                    if name == QUARANTINE_DIRNAME: continue
+                    if exclude and match_globs(relative + name, name, exclude): continue
+                    sub_path = os.path.join(dir_path, name)
+                    pending[executor.submit(scan_directory, sub_path, mtime_ns, dir_index)] = \
+                        (sub_path, f"{relative}{name}/", depth + 1)
+    if dir_index:
+        if max_depth is None and not exclude:
+            dir_index.prune(folder_paths, visited)
+        dir_index.save()
+    return sorted(set(results))  # 选中的文件夹互相嵌套时同一文件会被找到两次
+
+def split_globs(text):
+    """把用分号分隔的通配符字符串（或列表）拆成列表"""
+    if isinstance(text, (list, tuple)):
+        return [pattern.strip() for pattern in text if pattern.strip()]
+    return [pattern.strip() for pattern in (text or '').split(';') if pattern.strip()]
+
+shared_dir_index = DirectoryIndex(DIR_INDEX_PATH)  # 各会话的扫描共用一份目录索引
+
+def walk_options_from_request(data):
+    """从请求参数中读取遍历选项：include/exclude 为分号分隔的通配符，max_depth 为空表示不限"""
+    max_depth = data.get('max_depth')
+    return {
+        'include': split_globs(data.get('include')),
+        'exclude': split_globs(data.get('exclude')),
+        'max_depth': int(max_depth) if max_depth not in (None, '') else None,
+        'dir_index': shared_dir_index,
+    }
+
+def path_matches_walk(path, folder_paths, include=None, exclude=None, max_depth=None, **_):
+    """判断单个文件是否在 walk_files 会返回的范围内（监视模式中的新文件使用）"""
+    path = os.path.abspath(path)
+    for folder_path in folder_paths:
+        # 按带结尾分隔符的绝对路径前缀判断，relpath 在 Windows 跨盘符时会抛出 ValueError
+        root = os.path.join(os.path.abspath(folder_path), '')
+        if not os.path.normcase(path).startswith(os.path.normcase(root)):
+            continue
+        parts = path[len(root):].replace(os.sep, '/').split('/')
+        if QUARANTINE_DIRNAME in parts[:-1]:
+            return False
+        if max_depth is not None and len(parts) - 1 > max_depth:
+            return False
+        if include and not match_globs('/'.join(parts), parts[-1], include):
+            return False
+        if exclude and any(match_globs('/'.join(parts[:k + 1]), parts[k], exclude) for k in range(len(parts))):
+            return False
+        return True
+    return False
+
+def collect_image_paths(folder_paths, reference_path=None, include=None, exclude=None, max_depth=None, dir_index=None):
+    """收集所有图片文件和压缩包（不包括参考图片和隔离区），压缩包中的图片在计算哈希时逐个流式读取。遍历参数见 walk_files"""
+    image_paths = walk_files([os.path.normpath(folder_path) for folder_path in folder_paths],
+                             lambda name: allowed_file(name) or is_archive(name), include, exclude, max_depth, dir_index)
+    return [os.path.normpath(path) for path in image_paths if os.path.normpath(path) != reference_path]
+
+def hash_image_source(source, hash_size, algorithms=DEFAULT_HASH_ALGORITHMS):
+    """计算一个来源的哈希：普通图片返回一项，压缩包返回其中每张图片，格式为 [(标识, 哈希), ...]"""
+    if is_archive(source):
+        return [(identifier, calculate_image_hashes(identifier, hash_size, algorithms, fileobj))
+                for identifier, fileobj in iter_archive_images(source)]
+    return [(source, calculate_image_hashes(source, hash_size, algorithms))]
+
+class SessionState:
+    """每个浏览器会话独立的扫描状态"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.folders = []
+        self.reference_image_path = None
+        self.hash_db_path = None  # 图片比较器导出的二进制哈希库
+        self.watcher = None  # 本会话的文件夹监视器
+        self.last_access = time.time()
+
+def get_session_state():
+    """返回当前请求所属会话的状态，首次访问时创建"""
+    session_id = session.get('sid')
+    if not session_id:
+        session_id = session['sid'] = uuid.uuid4().hex
+    with sessions_lock:
+        if session_id not in sessions:
+            sessions[session_id] = SessionState(session_id)
+        state = sessions[session_id]
+        state.last_access = time.time()
+        return state
+
+def running_watchers():
+    with sessions_lock:
+        return [state.watcher for state in sessions.values() if state.watcher and state.watcher.is_running]
+
+def expire_sessions(idle_seconds=None):
+    """清除闲置的会话；有任务排队/运行或监视正在运行的会话保留"""
+    idle_seconds = idle_seconds if idle_seconds is not None else app.config['SESSION_IDLE_SECONDS']
+    cutoff = time.time() - idle_seconds
+    busy = {job.state.session_id for job in job_manager.active_jobs()}
+    with sessions_lock:
+        expired = [session_id for session_id, state in sessions.items()
+                   if state.last_access < cutoff and session_id not in busy
+                   and not (state.watcher and state.watcher.is_running)]
+        for session_id in expired:
+            del sessions[session_id]
+    if expired:
+        logger.info(f"Expired {len(expired)} idle sessions")
+    return len(expired)
+
+def reference_image_info(reference_path):
+    return {
+        'path': reference_path,
+        'name': os.path.basename(reference_path),
+        'base64': image_to_base64(reference_path),
+        'size': image_source_size(reference_path)
+    }
+
+class ScanJob:
+    """一次查找相似图片的任务。
+
+    任务被拆成"准备"和"逐张比较"两类小任务，每个小任务返回后续要执行的小任务，
+    由 JobManager 在共享线程池上与其他任务轮流调度。
+    """
+
+    def __init__(self, state, reference_path, folder_paths, threshold, hash_size, socket_id=None, db_path=None,
+                 algorithms=DEFAULT_HASH_ALGORITHMS, walk_options=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.state = state
+        self.reference_path = reference_path
+        self.folder_paths = list(folder_paths)
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.socket_id = socket_id
+        self.db_path = db_path
+        self.algorithms = tuple(algorithms)
+        self.walk_options = walk_options or {}
+        self.status = 'queued'
+        self.error = None
+        self.total = 0
+        self.processed = 0
+        self.results = []
+        self.last_journal = None  # 最近一次对本任务结果执行的批量操作日志，用于撤销
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.ready = deque([self.prepare])  # 等待调度的小任务
+        self.in_flight = 0
+        self.ref_hashes = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def emit_progress(self, status, stage='compare'):
+        if self.socket_id:
+            socketio.emit('progress', {
+                'job_id': self.id,
+                'current': self.processed,
+                'total': self.total,
+                'percent': int(self.processed / self.total * 100) if self.total else 100,
+                'status': status,
+                'stage': stage
+            }, room=self.socket_id)
+
+    def prepare(self):
+        if self.db_path:
+            matches = match_images_in_db(self.reference_path, self.db_path, self.threshold)
+            self.total = len(matches)
+            self.emit_progress(f'哈希库中找到 {len(matches)} 张相似图片，正在生成预览...')
+            return [functools.partial(self.add_result, path, similarity) for path, similarity in matches]
+
+        # 计算参考图片的哈希值
+        self.ref_hashes = calculate_image_hashes(self.reference_path, self.hash_size, self.algorithms)
+        if not self.ref_hashes:
+            return []
+        image_paths = collect_image_paths(self.folder_paths, self.reference_path, **self.walk_options)
+        self.total = len(image_paths)
+        self.emit_progress('开始比较图片相似度...')
+        return [functools.partial(self.process_image, path) for path in image_paths]
+
+    def process_image(self, image_path):
+        """比较一个来源；压缩包作为一个小任务顺序读完，进度按来源计数"""
+        for identifier, img_hashes in hash_image_source(image_path, self.hash_size, self.algorithms):
+            similarity = calculate_similarity(self.ref_hashes, img_hashes, self.threshold) if img_hashes else 0
+            if similarity >= self.threshold:
+                result = build_image_result(identifier, similarity)
+                with self.lock:
+                    self.results.append(result)
+        self.mark_processed(image_path)
+
+    def add_result(self, image_path, similarity):
+        result = build_image_result(image_path, similarity)
+        with self.lock:
+            self.results.append(result)
+        self.mark_processed(image_path)
+
+    def mark_processed(self, image_path):
+        with self.lock:
+            self.processed += 1
+            processed = self.processed
+        if processed % 5 == 0:
+            self.emit_progress(f'正在比较图片 {os.path.basename(image_path)}...')
+
+    def complete(self):
+        """所有小任务结束后由 JobManager 调用"""
+        self.finished = time.time()
+        if self.error:
+            self.status = 'failed'
+            logger.error(f"Job {self.id} failed: {self.error}")
+            if self.socket_id:
+                socketio.emit('processing_complete', {'success': False, 'job_id': self.id, 'error': self.error},
+                              room=self.socket_id)
+        elif self.cancelled:
+            self.status = 'cancelled'
+            self.emit_progress('任务已取消', stage='complete')
+        else:
+            self.status = 'done'
+            # 按相似度降序排序
+            self.results.sort(key=lambda x: x['similarity'], reverse=True)
+            self.processed = self.total
+            self.emit_progress('处理完成！', stage='complete')
+            if self.socket_id:
+                socketio.emit('processing_complete', {
+                    'success': True,
+                    'job_id': self.id,
+                    'similar_images': self.results,
+                    'reference_image': reference_image_info(self.reference_path)
+                }, room=self.socket_id)
+        self.done.set()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'current': self.processed,
+            'total': self.total,
+            'result_count': len(self.results),
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+class JobQueueFull(Exception):
+    pass
+
+class JobManager:
+    """有界的任务管理器：准入控制 + 在共享线程池上按任务轮转调度小任务。
+
+    线程池中同时执行的小任务数不超过线程池大小，每次从下一个有待执行小任务的任务中取一个，
+    因此多个用户同时扫描时各自的进度均匀推进，大任务不会饿死小任务。
+    """
+
+    def __init__(self, pool, pool_size, max_active_jobs, max_finished_jobs=100):
+        self.pool = pool
+        self.free_slots = pool_size
+        self.max_active_jobs = max_active_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.active = deque()
+        self.cond = threading.Condition()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def submit(self, job):
+        with self.cond:
+            if len(self.active) >= self.max_active_jobs:
+                raise JobQueueFull(f'当前已有 {len(self.active)} 个任务在排队或运行，请稍后再试')
+            self.jobs[job.id] = job
+            self.active.append(job)
+            self._prune()
+            self.cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def list(self, session_id):
+        with self.cond:
+            return [job for job in self.jobs.values() if job.state.session_id == session_id]
+
+    def active_jobs(self):
+        with self.cond:
+            return list(self.active)
+
+    def cancel(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if not job or job.status not in ('queued', 'running'):
+                return False
+            job.cancelled = True
+            job.ready.clear()
+            finished = job.in_flight == 0 and job in self.active
+            if finished:
+                self.active.remove(job)
+        if finished:
+            job.complete()
+        return True
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status not in ('queued', 'running')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def _next_task(self):
+        for _ in range(len(self.active)):
+            job = self.active[0]
+            self.active.rotate(-1)
+            if job.ready:
+                return job, job.ready.popleft()
+        return None, None
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                job, task = None, None
+                while job is None:
+                    if self.free_slots > 0:
+                        job, task = self._next_task()
+                    if job is None:
+                        self.cond.wait()
+                self.free_slots -= 1
+                job.in_flight += 1
+                if job.status == 'queued':
+                    job.status = 'running'
+                    job.started = time.time()
+            self.pool.submit(self._run, job, task)
+
+    def _run(self, job, task):
+        next_tasks = None
+        try:
+            if not job.cancelled:
+                next_tasks = task()
+        except Exception as e:
+            job.error = str(e)
+        with self.cond:
+            self.free_slots += 1
+            job.in_flight -= 1
+            if job.error:
+                job.ready.clear()
+            elif next_tasks:
+                job.ready.extend(next_tasks)
+            finished = not job.ready and job.in_flight == 0 and job in self.active
+            if finished:
+                self.active.remove(job)
+            self.cond.notify_all()
+        if finished:
+            job.complete()
+
+job_manager = JobManager(executor, app.config['THREAD_POOL_SIZE'], app.config['MAX_ACTIVE_JOBS'])
 
 def clean_cache():
     """定期清理缓存"""
@@ -250,10 +902,607 @@ def start_cache_cleaner():
     while True:
         time.sleep(600)  # 每10分钟清理一次
         clean_cache()
+        expire_sessions()
 
 cache_cleaner_thread = threading.Thread(target=start_cache_cleaner, daemon=True)
 cache_cleaner_thread.start()
 
+# 文件夹监视：常驻索引 + inotify/轮询，新文件稳定后只与索引比较，不再全量扫描
+class ResidentIndex:
+    """常驻内存的哈希索引，按列存放 uint64 哈希，查询一次是一组向量化运算"""
+
+    def __init__(self, hash_size, algorithms=DEFAULT_HASH_ALGORITHMS):
+        self.hash_size = hash_size
+        self.algorithms = tuple(algorithms)
+        self.words = {name: (HASH_ALGORITHMS[name].bits(hash_size) + 63) // 64 for name in self.algorithms}
+        self.paths = []
+        self.positions = {}
+        self.columns = {name: numpy.zeros((0, self.words[name]), dtype=numpy.uint64) for name in self.algorithms}
+        self.alive = numpy.zeros(0, dtype=bool)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _grow(self):
+        capacity = max(1024, len(self.alive) * 2)
+        for name in self.columns:
+            column = numpy.zeros((capacity, self.words[name]), dtype=numpy.uint64)
+            column[:len(self.paths)] = self.columns[name][:len(self.paths)]
+            self.columns[name] = column
+        alive = numpy.zeros(capacity, dtype=bool)
+        alive[:len(self.paths)] = self.alive[:len(self.paths)]
+        self.alive = alive
+
+    def _compact(self):
+        """丢弃已删除条目占用的行，重建位置表"""
+        keep = numpy.flatnonzero(self.alive[:len(self.paths)])
+        self.paths = [self.paths[i] for i in keep]
+        self.positions = {path: position for position, path in enumerate(self.paths)}
+        for name in self.columns:
+            self.columns[name] = self.columns[name][keep]
+        self.alive = numpy.ones(len(keep), dtype=bool)
+
+    def add(self, path, hashes):
+        with self.lock:
+            # 已在索引中的路径（文件被修改）原地覆盖，不留下空行
+            position = self.positions.get(path)
+            if position is None:
+                if len(self.paths) == len(self.alive):
+                    self._grow()
+                position = len(self.paths)
+                self.paths.append(path)
+                self.positions[path] = position
+            for name in self.algorithms:
+                self.columns[name][position] = hex_to_words(hashes[name], self.words[name])
+            self.alive[position] = True
+
+    def remove(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def remove_prefix(self, prefix):
+        """移除路径以 prefix 开头的所有条目，用于整体移除一个压缩包中的图片"""
+        with self.lock:
+            for path in [path for path in self.positions if path.startswith(prefix)]:
+                self._remove(path)
+
+    def _remove(self, path):
+        position = self.positions.pop(path, None)
+        if position is not None:
+            self.alive[position] = False
+            # 已删除的行多于存活的行时压缩，避免长时间监视后列数组只增不减
+            dead = len(self.paths) - len(self.positions)
+            if dead > max(1024, len(self.positions)):
+                self._compact()
+
+    def query(self, hashes, threshold, exclude=None):
+        """返回索引中与给定哈希相似度不低于阈值的 (路径, 相似度)，按相似度降序"""
+        with self.lock:
+            size = len(self.paths)
+            if not size:
+                return []
+            hits, combined = score_hash_columns(self.columns.get, hashes, self.algorithms, self.hash_size, threshold,
+                                                numpy.flatnonzero(self.alive[:size]))
+            matches = [(self.paths[i], float(similarity)) for i, similarity in zip(hits, combined)
+                       if self.paths[i] != exclude]
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+class PollingBackend:
+    """stat 轮询后端：每次对比文件快照，报告新增/变化和删除的文件"""
+
+    def __init__(self, folder_paths):
+        self.folder_paths = folder_paths
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for folder_path in self.folder_paths:
+            for root, dirs, files in os.walk(folder_path):
+                dirs[:] = [d for d in dirs if d != QUARANTINE_DIRNAME]
+                for file in files:
+                    full_path = os.path.normpath(os.path.join(root, file))
+                    try:
+                        stat = os.stat(full_path)
+                    except OSError:
+                        continue
+                    snapshot[full_path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(timeout)
+        snapshot = self._scan()
+        events = [('changed', path) for path, sig in snapshot.items() if self.snapshot.get(path) != sig]
+        events.extend(('deleted', path) for path in self.snapshot if path not in snapshot)
+        self.snapshot = snapshot
+        return events
+
+    def close(self):
+        pass
+
+class InotifyBackend:
+    """Linux inotify 后端（通过 ctypes 调用 libc），递归监视所有子目录"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, folder_paths):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.pending_events = []
+        for folder_path in folder_paths:
+            self._watch_tree(os.path.normpath(folder_path), report_files=False)
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux') and bool(ctypes.util.find_library('c'))
+
+    def _watch_tree(self, folder_path, report_files):
+        if os.path.basename(folder_path) == QUARANTINE_DIRNAME:
+            return
+        for root, dirs, files in os.walk(folder_path):
+            dirs[:] = [d for d in dirs if d != QUARANTINE_DIRNAME]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"Cannot watch {root}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = root
+            if report_files:
+                # 目录创建和监视之间写入的文件不会产生事件，这里补报一次
+                self.pending_events.extend(('changed', os.path.join(root, file)) for file in files)
+
+    def _unwatch_tree(self, folder_path):
+        """移除目录及其子目录的监视，移走的目录继续产生的事件路径已经不对"""
+        prefix = folder_path + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == folder_path or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def poll(self, timeout):
+        events, self.pending_events = self.pending_events, []
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return events
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & self.IN_Q_OVERFLOW:
+                # 内核事件队列溢出，之前的事件已丢失，交给上层重新遍历
+                events.append(('rescan', None))
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            full_path = os.path.normpath(os.path.join(self.watches[wd], os.fsdecode(name)))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch_tree(full_path, report_files=True)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    # 目录移出监视范围时其中的文件不会逐个产生事件，整体报告一次
+                    self._unwatch_tree(full_path)
+                    events.append(('deleted_dir', full_path))
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                events.append(('deleted', full_path))
+            else:
+                events.append(('changed', full_path))
+        # 新目录中补报的文件只返回这一次
+        events.extend(self.pending_events)
+        self.pending_events = []
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    """持续监视文件夹：新文件写入稳定后计算哈希、查询常驻索引、通过回调发出重复事件"""
+
+    def __init__(self, folder_paths, threshold, hash_size, callback, settle_seconds=2.0, poll_interval=1.0,
+                 db_path=None, use_inotify=True, algorithms=DEFAULT_HASH_ALGORITHMS, walk_options=None):
+        self.folder_paths = [os.path.abspath(folder_path) for folder_path in folder_paths]  # 与 walk_files 返回的路径一致
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.callback = callback
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.db_path = db_path
+        self.use_inotify = use_inotify
+        self.algorithms = tuple(algorithms)
+        self.walk_options = walk_options or {}
+        self.index = None
+        self.pending = {}  # 路径 -> (文件签名, 签名最后变化的时间)
+        self.is_running = False
+        self.thread = None
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread:
+            self.thread.join(timeout=self.poll_interval + 5)
+
+    def build_index(self):
+        """用哈希库或现有文件建立常驻索引"""
+        if self.db_path:
+            db = HashDatabase(self.db_path)
+            self.hash_size = db.hash_size
+            self.algorithms = db.algorithms
+        self.index = ResidentIndex(self.hash_size, self.algorithms)
+        if self.db_path:
+            valid = db.column('valid')
+            for i in range(len(db)):
+                if valid[i]:
+                    self.index.add(db.path(i), db.hex_hashes(i))
+            return
+
+        existing = collect_image_paths(self.folder_paths, **self.walk_options)
+        for entries in index_executor.map(lambda p: hash_image_source(p, self.hash_size, self.algorithms), existing):
+            for path, hashes in entries:
+                if hashes:
+                    self.index.add(path, hashes)
+
+    def run(self):
+        backend = None
+        try:
+            self.build_index()
+            self.callback({'type': 'ready', 'indexed': len(self.index), 'timestamp': time.time()})
+            if self.use_inotify and InotifyBackend.available():
+                backend = InotifyBackend(self.folder_paths)
+            else:
+                backend = PollingBackend(self.folder_paths)
+            logger.info(f"Watching {self.folder_paths} with {type(backend).__name__}")
+            while self.is_running:
+                for kind, path in backend.poll(self.poll_interval):
+                    if kind == 'rescan':
+                        self.rescan()
+                    elif kind == 'deleted':
+                        self.pending.pop(path, None)
+                        self.remove_source(path)
+                    elif kind == 'deleted_dir':
+                        self.remove_folder(path)
+                    elif (allowed_file(path) or is_archive(path)) and \
+                            path_matches_walk(path, self.folder_paths, **self.walk_options):
+                        self.pending.setdefault(path, (None, time.time()))
+                self.process_settled()
+        except Exception as e:
+            # 例如 inotify 监视数达到上限；线程退出前报告错误，状态查询和重新开始监视都能看到已停止
+            logger.error(f"Folder watcher for {self.folder_paths} stopped: {e}")
+            self.callback({'type': 'error', 'error': str(e), 'timestamp': time.time()})
+        finally:
+            self.is_running = False
+            if backend:
+                backend.close()
+
+    def rescan(self):
+        """事件丢失后重新遍历文件夹：索引中没有的文件等待处理，已不存在的文件移出索引"""
+        logger.warning(f"Event queue overflowed, rescanning {self.folder_paths}")
+        existing = set(collect_image_paths(self.folder_paths, **self.walk_options))
+        with self.index.lock:
+            # 压缩包成员按所属压缩包对比
+            indexed = {archive_of(path) or path for path in self.index.positions}
+        now = time.time()
+        for path in existing - indexed:
+            self.pending.setdefault(path, (None, now))
+        for path in indexed - existing:
+            if path_matches_walk(path, self.folder_paths, **self.walk_options) and not os.path.exists(path):
+                self.pending.pop(path, None)
+                self.remove_source(path)
+
+    def remove_folder(self, folder_path):
+        """目录被删除或移出监视范围：移除其中所有已索引和等待处理的文件"""
+        prefix = folder_path + os.sep
+        for path in [path for path in self.pending if path.startswith(prefix)]:
+            del self.pending[path]
+        self.index.remove_prefix(prefix)
+
+    def remove_source(self, path):
+        """从索引中移除文件；压缩包连同其中的所有图片一起移除"""
+        if not is_archive(path):
+            self.index.remove(path)
+            return
+        self.index.remove_prefix(path + ARCHIVE_SEPARATOR)
+
+    def process_settled(self):
+        now = time.time()
+        for path, (signature, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle_seconds:
+                del self.pending[path]
+                self.process_file(path)
+
+    def process_file(self, path):
+        if is_archive(path):
+            # 压缩包被改写后先移除旧成员，再逐个检查现有成员
+            self.remove_source(path)
+        for identifier, hashes in hash_image_source(path, self.hash_size, self.algorithms):
+            if not hashes:
+                continue
+            matches = self.index.query(hashes, self.threshold, exclude=identifier)
+            self.index.add(identifier, hashes)
+            if matches:
+                self.callback({
+                    'type': 'duplicate',
+                    'path': identifier,
+                    'matches': [{'path': match_path, 'similarity': similarity} for match_path, similarity in matches],
+                    'timestamp': time.time()
+                })
+
+# 批量去重操作：分批并行执行删除/隔离/硬链接替换，追加写日志，支持撤销和崩溃恢复
+ACTION_DELETE = 'delete'
+ACTION_QUARANTINE = 'quarantine'
+ACTION_HARDLINK = 'hardlink'
+ACTION_REFLINK = 'reflink'
+LINK_ACTIONS = (ACTION_HARDLINK, ACTION_REFLINK)
+ACTIONS = (ACTION_DELETE, ACTION_QUARANTINE) + LINK_ACTIONS
+REFLINK_SUPPORTED = sys.platform.startswith('linux')
+QUARANTINE_DIRNAME = '.similarity-quarantine'
+FICLONE = 0x40049409  # Linux ioctl，Btrfs/XFS 等文件系统上的写时复制克隆
+
+def reflink_file(src, dst):
+    """不支持 reflink 的系统或文件系统上抛出 OSError(EOPNOTSUPP)"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "当前系统不支持 reflink")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError as e:
+            raise OSError(errno.EOPNOTSUPP, f"reflink 失败: {e.strerror or e}") from e
+
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.move(src, dst)
+
+class BulkActionEngine:
+    """执行批量去重计划。
+
+    每一批先把 begin 记录写入日志并落盘，再并行操作文件，成功的写 commit 记录。
+    隔离和链接替换会把原文件移动到同目录下的隔离区（同一文件系统内只是改名），
+    因此可以撤销；中途崩溃时 recover() 会回滚只有 begin 没有 commit 的操作。
+    """
+
+    def __init__(self, state_dir, max_workers=None, batch_size=256):
+        self.journal_dir = os.path.join(state_dir, 'journal')
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 4) * 4)
+        self.batch_size = batch_size
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+    def execute(self, plan, progress=None):
+        """plan 为 [(操作, 路径, 保留的图片)]，返回 (日志路径, 成功的条目, 失败的条目)。操作不在 ACTIONS 中时抛出 ValueError。"""
+        for action, _, _ in plan:
+            if action not in ACTIONS:
+                raise ValueError(f"未知的操作: {action}")
+        session = time.strftime('%Y%m%d-%H%M%S') + f"-{uuid.uuid4().hex[:8]}"
+        journal_path = os.path.join(self.journal_dir, f"{session}.jsonl")
+        entries = []
+        for seq, (action, path, keeper) in enumerate(plan):
+            backup = None
+            if action != ACTION_DELETE:
+                backup = os.path.join(os.path.dirname(path), QUARANTINE_DIRNAME, session,
+                                      f"{seq:08d}_{os.path.basename(path)}")
+            entries.append({'seq': seq, 'action': action, 'path': path, 'keeper': keeper, 'backup': backup})
+
+        completed, failed = [], []
+        with open(journal_path, 'a', encoding='utf-8') as journal, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for start in range(0, len(entries), self.batch_size):
+                batch = entries[start:start + self.batch_size]
+                self._append(journal, [dict(entry, event='begin') for entry in batch])
+                results = list(executor.map(self._apply, batch))
+                self._append(journal, [{'event': 'commit', 'seq': entry['seq']}
+                                       for entry, error in zip(batch, results) if error is None])
+                for entry, error in zip(batch, results):
+                    if error is None:
+                        completed.append(entry)
+                    else:
+                        failed.append(dict(entry, error=error))
+                if progress:
+                    progress(min(start + self.batch_size, len(entries)), len(entries))
+        return journal_path, completed, failed
+
+    def _append(self, journal, records):
+        if not records: return
+        journal.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _apply(self, entry):
+        action, path, keeper, backup = entry['action'], entry['path'], entry['keeper'], entry['backup']
+        try:
+            if action == ACTION_DELETE:
+                os.remove(path)
+                return None
+            os.makedirs(os.path.dirname(backup), exist_ok=True)
+            if action == ACTION_QUARANTINE:
+                move_file(path, backup)
+                return None
+
+            # 先在临时名上建立链接，成功后再把原文件移入隔离区并原子替换
+            temp_path = f"{path}.simlink-tmp"
+            try:
+                if action == ACTION_HARDLINK:
+                    os.link(keeper, temp_path)
+                else:
+                    reflink_file(keeper, temp_path)
+                move_file(path, backup)
+                try:
+                    os.replace(temp_path, path)
+                except OSError:
+                    move_file(backup, path)  # 原文件已在隔离区，替换失败时立即放回，不等到撤销
+                    raise
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            return None
+        except Exception as e:  # 单个条目出错只记为失败，不中断整批操作
+            return str(e)
+
+    def read_journal(self, journal_path):
+        entries, finished = {}, {}
+        with open(journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 崩溃时最后一行可能不完整
+                if record['event'] == 'begin':
+                    entries[record['seq']] = record
+                else:
+                    finished.setdefault(record['seq'], set()).add(record['event'])
+        return entries, finished
+
+    def _restore(self, entry):
+        backup, path = entry['backup'], entry['path']
+        if backup and os.path.exists(backup):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            move_file(backup, path)  # 链接替换时会覆盖链接，恢复原文件
+            return True
+        return False
+
+    def undo(self, journal_path):
+        """撤销一次操作，返回 (已恢复的条目, 无法恢复的条目)。删除操作无法撤销。"""
+        entries, finished = self.read_journal(journal_path)
+        restored, unrecoverable, records = [], [], []
+        for seq in sorted(entries, reverse=True):
+            events = finished.get(seq, set())
+            if 'commit' not in events or events & {'undo', 'purge'}:
+                continue
+            entry = entries[seq]
+            try:
+                if self._restore(entry):
+                    restored.append(entry)
+                    records.append({'event': 'undo', 'seq': seq})
+                else:
+                    unrecoverable.append(entry)
+            except OSError:
+                unrecoverable.append(entry)
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            self._append(journal, records)
+        return restored, unrecoverable
+
+    def recover(self):
+        """回滚所有日志中未完成（只有 begin）的操作，返回回滚的条目数。"""
+        rolled_back = 0
+        for journal_path in self.journals():
+            entries, finished = self.read_journal(journal_path)
+            records = []
+            for seq, entry in entries.items():
+                if seq in finished:
+                    continue
+                temp_path = f"{entry['path']}.simlink-tmp"
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                # 链接替换可能已经覆盖了原路径，隔离只在原路径不存在时恢复
+                if entry['action'] in LINK_ACTIONS or not os.path.exists(entry['path']):
+                    try:
+                        self._restore(entry)
+                    except OSError:
+                        pass
+                records.append({'event': 'rollback', 'seq': seq})
+            if records:
+                with open(journal_path, 'a', encoding='utf-8') as journal:
+                    self._append(journal, records)
+                rolled_back += len(records)
+        return rolled_back
+
+    def purge(self, journal_path):
+        """清空一次操作的隔离区，真正释放磁盘空间，之后无法撤销。"""
+        entries, finished = self.read_journal(journal_path)
+        records = []
+        for seq, entry in entries.items():
+            events = finished.get(seq, set())
+            if 'commit' in events and not events & {'undo', 'purge'} and entry['backup']:
+                try:
+                    os.remove(entry['backup'])
+                except FileNotFoundError:
+                    pass
+                records.append({'event': 'purge', 'seq': seq})
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            self._append(journal, records)
+        return len(records)
+
+    def journals(self):
+        return sorted(os.path.join(self.journal_dir, name) for name in os.listdir(self.journal_dir)
+                      if name.endswith('.jsonl'))
+
+action_engine = BulkActionEngine(os.path.join(os.path.expanduser('~'), '.image_similarity'))
+
+def run_bulk_action(job, paths, action, socket_id=None):
+    """以任务的参考图片为保留原件执行批量操作，并原地更新任务的结果列表和监视索引。
+
+    同一浏览器的多个标签页共用一个会话，所以结果、保留原件和撤销日志都跟随任务而不是会话。
+    """
+    keeper = job.reference_path
+    if action in LINK_ACTIONS and not keeper:
+        raise ValueError('没有选择参考图片')
+    # 压缩包中的图片不能单独处理
+    plan = [(action, path, keeper) for path in paths
+            if os.path.normpath(path) != os.path.normpath(keeper or '') and not split_archive_identifier(path)]
+
+    def report(done, total):
+        if socket_id:
+            socketio.emit('progress', {
+                'current': done,
+                'total': total,
+                'percent': int(done / total * 100),
+                'status': f'正在执行批量操作... ({done}/{total})',
+                'stage': 'action'
+            }, room=socket_id)
+
+    journal_path, completed, failed = action_engine.execute(plan, report)
+    job.last_journal = journal_path
+    processed = {entry['path'] for entry in completed}
+    with job.lock:
+        job.results = [img for img in job.results if img['path'] not in processed]
+    # 文件是所有会话共享的，正在运行的监视索引都要同步
+    for watcher in running_watchers():
+        if not watcher.index:
+            continue
+        for entry in completed:
+            if entry['action'] in LINK_ACTIONS:
+                hashes = calculate_image_hashes(entry['path'], watcher.hash_size, watcher.algorithms)
+                if hashes:
+                    watcher.index.add(entry['path'], hashes)
+            else:
+                watcher.index.remove(entry['path'])
+    logger.info(f"Bulk {action} completed. Succeeded: {len(completed)}, Failed: {len(failed)}, Journal: {journal_path}")
+    return completed, failed
+
 def open_folder_dialog():
     """使用Tkinter选择文件夹"""
     root = tk.Tk()
@@ -269,13 +1518,24 @@ def open_folder_dialog():
         mustexist=True,
         parent=root  # 指定父窗口
     )
-    if folder_paths:
-        # 将选中的文件夹路径添加到全局变量中
-        if folder_paths not in selected_folders:
-            selected_folders.append(folder_paths)
     root.destroy()
     return folder_paths
 
+def select_hash_db_file():
+    """使用Tkinter选择二进制哈希库"""
+    root = tk.Tk()
+    root.withdraw()  # 隐藏主窗口
+    root.attributes('-topmost', True)
+    root.focus_force()
+    root.lift()
+    file_path = filedialog.askopenfilename(
+        title='选择哈希库',
+        filetypes=[('Hash database', '*.simdb'), ('All files', '*.*')],
+        parent=root
+    )
+    root.destroy()
+    return file_path
+
 def select_reference_image():
     """使用Tkinter选择参考图片"""
     root = tk.Tk()
@@ -296,81 +1556,133 @@ def select_reference_image():
 
 @app.route('/')
 def index():
-    return render_template('index.html', folders=selected_folders)
+    return render_template('index.html', folders=get_session_state().folders, algorithms=list(HASH_ALGORITHMS),
+                           default_algorithms=DEFAULT_HASH_ALGORITHMS, reflink_supported=REFLINK_SUPPORTED)
 
 @app.route('/select_folder', methods=['POST'])
 def select_folder_route():
-    open_folder_dialog()
-    return jsonify({'success': True, 'folders': selected_folders})
+    state = get_session_state()
+    folder_path = open_folder_dialog()
+    # 将选中的文件夹路径添加到当前会话中
+    if folder_path and folder_path not in state.folders:
+        state.folders.append(folder_path)
+    return jsonify({'success': True, 'folders': state.folders})
+
+@app.route('/select_hash_db', methods=['POST'])
+def select_hash_db_route():
+    state = get_session_state()
+    db_path = select_hash_db_file()
+    if not db_path:
+        return jsonify({'success': False, 'error': '未选择哈希库'})
+    try:
+        db = HashDatabase(db_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"Error opening hash database {db_path}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
+    state.hash_db_path = db_path
+    return jsonify({'success': True, 'hash_db': {'path': db_path, 'count': len(db), 'hash_size': db.hash_size}})
+
+@app.route('/clear_hash_db', methods=['POST'])
+def clear_hash_db_route():
+    get_session_state().hash_db_path = None
+    return jsonify({'success': True})
 
 @app.route('/select_reference_image', methods=['POST'])
 def select_reference_image_route():
-    global reference_image_path
-    reference_image_path = select_reference_image()
-    if reference_image_path:
+    state = get_session_state()
+    state.reference_image_path = select_reference_image()
+    if state.reference_image_path:
         return jsonify({
             'success': True, 
-            'reference_image': {
-                'path': reference_image_path,
-                'name': os.path.basename(reference_image_path),
-                'base64': image_to_base64(reference_image_path),
-                'size': os.path.getsize(reference_image_path) if os.path.exists(reference_image_path) else 0
-            }
+            'reference_image': reference_image_info(state.reference_image_path)
         })
     return jsonify({'success': False, 'error': '未选择图片'})
 
 @app.route('/process_images', methods=['POST'])
 def process_images_route():
+    state = get_session_state()
     data = request.get_json()
     threshold = float(data.get('threshold', 80))
     hash_size = int(data.get('hash_size', 8))
     socket_id = data.get('socket_id')
+    try:
+        algorithms = resolve_hash_algorithms(data.get('algorithms'), hash_size)
+        walk_options = walk_options_from_request(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    if not selected_folders:
+    if not state.folders and not state.hash_db_path:
         return jsonify({'error': '没有选择文件夹'}), 400
     
-    if not reference_image_path:
+    if not state.reference_image_path:
         return jsonify({'error': '没有选择参考图片'}), 400
     
-    # 在新线程中处理图片
-    def process_thread():
-        try:
-            similar_images = find_similar_images(
-                reference_image_path, 
-                selected_folders, 
-                threshold, 
-                hash_size, 
-                socket_id
-            )
-            
-            socketio.emit('processing_complete', {
-                'success': True, 
-                'similar_images': similar_images,
-                'reference_image': {
-                    'path': reference_image_path,
-                    'name': os.path.basename(reference_image_path),
-                    'base64': image_to_base64(reference_image_path),
-                    'size': os.path.getsize(reference_image_path) if os.path.exists(reference_image_path) else 0
-                }
-            }, room=socket_id)
-        except Exception as e:
-            logger.error(f"Error in process_images: {str(e)}")
-            socketio.emit('processing_complete', {'success': False, 'error': str(e)}, room=socket_id)
-    
-    thread = threading.Thread(target=process_thread)
-    thread.daemon = True
-    thread.start()
+    # 提交到任务管理器，由共享线程池调度执行，结果通过 socket 推送
+    job = ScanJob(state, state.reference_image_path, state.folders, threshold, hash_size,
+                  socket_id, state.hash_db_path, algorithms, walk_options)
+    try:
+        job_manager.submit(job)
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'error': str(e)}), 429
     
-    return jsonify({'success': True, 'message': '处理已开始'})
+    return jsonify({'success': True, 'message': '处理已开始', 'job_id': job.id})
+
+def get_session_job(job_id):
+    job = job_manager.get(job_id)
+    if not job or job.state.session_id != get_session_state().session_id:
+        return None
+    return job
+
+def get_finished_job(data):
+    """批量操作的目标任务：请求中的 job_id 必须属于当前会话且已完成，否则返回 (None, 错误响应)"""
+    job = get_session_job((data or {}).get('job_id') or '')
+    if not job:
+        return None, (jsonify({"success": False, "error": "任务不存在"}), 404)
+    if job.status != 'done':
+        return None, (jsonify({"success": False, "error": f"任务状态为 {job.status}"}), 409)
+    return job, None
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs_route():
+    jobs = job_manager.list(get_session_state().session_id)
+    return jsonify({'success': True, 'jobs': [job.to_dict() for job in jobs]})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    job = get_session_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result_route(job_id):
+    job = get_session_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    if job.status != 'done':
+        return jsonify({'success': False, 'error': f'任务状态为 {job.status}', 'job': job.to_dict()}), 409
+    return jsonify({
+        'success': True,
+        'similar_images': job.results,
+        'reference_image': reference_image_info(job.reference_path)
+    })
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel_route(job_id):
+    job = get_session_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({'success': False, 'error': '任务已结束'}), 409
+    return jsonify({'success': True, 'message': '任务已取消'})
 
 @app.route('/delete_image', methods=['POST'])
 def delete_image():
-    global similar_images
-    
     data = request.json
     image_path = data.get('image_path', '')
-    
-    logger.debug(f"Delete request received for image: {image_path}")
+    action = data.get('action', ACTION_DELETE)
+    if action not in ACTIONS:
+        return jsonify({"success": False, "error": f"未知的操作: {action}"}), 400
     
     if not image_path:
         logger.error("No image path provided in delete request")
@@ -378,82 +1690,162 @@ def delete_image():
     
     # 确保路径格式正确
     image_path = os.path.normpath(image_path)
-    logger.debug(f"Normalized image path: {image_path}")
     
+    if split_archive_identifier(image_path):
+        return jsonify({"success": False, "error": "压缩包中的图片不能单独处理"}), 400
+
+    job, error = get_finished_job(data)
+    if error:
+        return error
+    if image_path not in {os.path.normpath(img['path']) for img in job.results}:
+        return jsonify({"success": False, "error": "图片不在该任务的结果中"}), 400
+
     # 检查文件是否存在
     if not os.path.exists(image_path):
         logger.error(f"Image does not exist: {image_path}")
         return jsonify({"success": False, "error": "图片不存在"}), 404
     
     try:
-        # 删除文件
-        os.remove(image_path)
-        logger.info(f"Successfully deleted image: {image_path}")
-        
-        # 从相似图片列表中移除该图片
-        similar_images = [img for img in similar_images if img['path'] != image_path]
-        logger.debug(f"Removed image from similar_images list. Remaining: {len(similar_images)}")
-        
+        completed, failed = run_bulk_action(job, [image_path], action)
+        if failed:
+            return jsonify({"success": False, "error": failed[0]['error']}), 500
         return jsonify({"success": True})
     except Exception as e:
-        logger.error(f"Error deleting image {image_path}: {e}")
+        logger.error(f"Error processing image {image_path}: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/delete_all_similar', methods=['POST'])
 def delete_all_similar():
-    global similar_images
-    
     data = request.json
     socket_id = data.get('socket_id')
+    action = data.get('action', ACTION_DELETE)
+    if action not in ACTIONS:
+        return jsonify({"success": False, "error": f"未知的操作: {action}"}), 400
+    job, error = get_finished_job(data)
+    if error:
+        return error
     
-    logger.debug("Delete all similar images request received")
-    
-    if not similar_images:
+    if not job.results:
         logger.error("No similar images found for deletion")
         return jsonify({"success": False, "error": "没有找到相似图片"}), 400
     
     try:
-        deleted_images = []
-        failed_images = []
-        
-        for img in similar_images:
-            image_path = img['path']
-            logger.debug(f"Attempting to delete image: {image_path}")
-            
-            try:
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-                    deleted_images.append(image_path)
-                    logger.info(f"Successfully deleted image: {image_path}")
-                else:
-                    logger.warning(f"Image does not exist, skipping: {image_path}")
-                    failed_images.append(image_path)
-            except Exception as e:
-                logger.error(f"Error deleting image {image_path}: {e}")
-                failed_images.append(image_path)
-        
-        # 清空相似图片列表
-        similar_images = []
+        completed, failed = run_bulk_action(job, [img['path'] for img in job.results], action, socket_id)
+        message = f'已处理 {len(completed)} 张相似图片'
         
         socketio.emit('delete_complete', {
             'success': True,
-            'deleted_count': len(deleted_images),
-            'failed_count': len(failed_images),
-            'message': f'已删除 {len(deleted_images)} 张相似图片'
+            'deleted_count': len(completed),
+            'failed_count': len(failed),
+            'message': message
         }, room=socket_id)
         
-        logger.info(f"Delete all operation completed. Deleted: {len(deleted_images)}, Failed: {len(failed_images)}")
-        
         return jsonify({
             "success": True,
-            "deleted_count": len(deleted_images),
-            "failed_count": len(failed_images),
-            "message": f'已删除 {len(deleted_images)} 张相似图片'
+            "deleted_count": len(completed),
+            "failed_count": len(failed),
+            "message": message
         })
     except Exception as e:
         logger.error(f"Error in delete_all_similar: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/undo_last_action', methods=['POST'])
+def undo_last_action():
+    job, error = get_finished_job(request.get_json(silent=True))
+    if error:
+        return error
+    if not job.last_journal:
+        return jsonify({"success": False, "error": "没有可撤销的操作"}), 400
+    restored, unrecoverable = action_engine.undo(job.last_journal)
+    job.last_journal = None
+    message = f'已恢复 {len(restored)} 张图片'
+    if unrecoverable:
+        message += f'，{len(unrecoverable)} 张已删除的图片无法恢复'
+    return jsonify({"success": True, "restored_count": len(restored), "message": message})
+
+@app.route('/purge_quarantine', methods=['POST'])
+def purge_quarantine():
+    job, error = get_finished_job(request.get_json(silent=True))
+    if error:
+        return error
+    if not job.last_journal:
+        return jsonify({"success": False, "error": "没有可清空的隔离区"}), 400
+    purged = action_engine.purge(job.last_journal)
+    job.last_journal = None
+    return jsonify({"success": True, "message": f'已清空隔离区中的 {purged} 个文件'})
+
+@app.route('/watch/start', methods=['POST'])
+def watch_start_route():
+    data = request.get_json() or {}
+    threshold = float(data.get('threshold', 80))
+    hash_size = int(data.get('hash_size', 8))
+    socket_id = data.get('socket_id')
+    state = get_session_state()
+    try:
+        algorithms = resolve_hash_algorithms(data.get('algorithms'), hash_size)
+        walk_options = walk_options_from_request(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    if not state.folders:
+        return jsonify({'success': False, 'error': '没有选择文件夹'}), 400
+    if state.watcher and state.watcher.is_running:
+        return jsonify({'success': False, 'error': '监视已在运行'}), 409
+
+    def emit_event(event):
+        socketio.emit('watch_event', event, room=socket_id)
+
+    state.watcher = FolderWatcher(list(state.folders), threshold, hash_size, emit_event, db_path=state.hash_db_path,
+                                  algorithms=algorithms, walk_options=walk_options)
+    state.watcher.start()
+    return jsonify({'success': True, 'message': '监视已开始'})
+
+@app.route('/watch/stop', methods=['POST'])
+def watch_stop_route():
+    state = get_session_state()
+    if not state.watcher:
+        return jsonify({'success': False, 'error': '监视未运行'}), 400
+    state.watcher.stop()
+    state.watcher = None
+    return jsonify({'success': True, 'message': '监视已停止'})
+
+@app.route('/watch/status', methods=['GET'])
+def watch_status_route():
+    watcher = get_session_state().watcher
+    running = bool(watcher and watcher.is_running)
+    return jsonify({
+        'running': running,
+        'folders': watcher.folder_paths if running else [],
+        'indexed': len(watcher.index) if running and watcher.index else 0,
+        'pending': len(watcher.pending) if running else 0
+    })
+
+def run_headless_watch(args):
+    """无界面监视模式：重复事件以 JSON Lines 写入文件或标准输出"""
+    stream = open(args.jsonl, 'a', encoding='utf-8') if args.jsonl else sys.stdout
+    write_lock = threading.Lock()
+
+    def write_event(event):
+        with write_lock:
+            stream.write(json.dumps(event, ensure_ascii=False) + '\n')
+            stream.flush()
+
+    headless_watcher = FolderWatcher(args.watch, args.threshold, args.hash_size, write_event,
+                                     settle_seconds=args.settle, poll_interval=args.interval,
+                                     db_path=args.db, use_inotify=not args.poll, algorithms=args.algorithms,
+                                     walk_options={'include': args.include, 'exclude': args.exclude,
+                                                   'max_depth': args.max_depth,
+                                                   'dir_index': None if args.no_dir_index else DirectoryIndex(args.dir_index)})
+    headless_watcher.is_running = True
+    try:
+        headless_watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
 def open_browser():
     def _open_browser():
         time.sleep(1.5)
@@ -464,6 +1856,35 @@ def open_browser():
     thread.start()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='图片近似器')
+    parser.add_argument('--watch', nargs='+', metavar='FOLDER', help='无界面监视文件夹并输出重复事件')
+    parser.add_argument('--jsonl', help='事件输出文件（默认标准输出）')
+    parser.add_argument('--db', help='用于初始化索引的哈希库')
+    parser.add_argument('--threshold', type=float, default=80.0)
+    parser.add_argument('--hash-size', type=int, default=8)
+    parser.add_argument('--algorithms', default=','.join(DEFAULT_HASH_ALGORITHMS),
+                        help=f"逗号分隔的哈希算法，可用: {', '.join(HASH_ALGORITHMS)}")
+    parser.add_argument('--include', action='append', default=[], help="只处理匹配的文件，如 '*.jpg'，可重复")
+    parser.add_argument('--exclude', action='append', default=[], help="跳过匹配的文件和目录，如 'raw/*'，可重复")
+    parser.add_argument('--max-depth', type=int, help='最多进入几层子目录，0 表示只看根目录')
+    parser.add_argument('--dir-index', default=DIR_INDEX_PATH, help='目录 mtime 索引文件')
+    parser.add_argument('--no-dir-index', action='store_true', help='不读写目录 mtime 索引')
+    parser.add_argument('--settle', type=float, default=2.0, help='文件大小和修改时间保持不变多少秒后才处理')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--poll', action='store_true', help='强制使用轮询而不是 inotify')
+    args = parser.parse_args()
+    try:
+        args.algorithms = resolve_hash_algorithms(args.algorithms, args.hash_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.watch:
+        logging.getLogger().setLevel(logging.INFO)
+        run_headless_watch(args)
+        sys.exit(0)
+
+    rolled_back = action_engine.recover()
+    if rolled_back:
+        logger.info(f"Rolled back {rolled_back} interrupted file operations")
     logger.info("Starting Flask server on http://127.0.0.1:18210")
     open_browser()
     socketio.run(app, debug=False, port=18210)